@@ -1,15 +1,23 @@
 import os
 import sys
+import csv
 import argparse
+import itertools
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 import copy
 
+EXCEL_EXTS = [".xlsx", ".xlsm", ".xltx", ".xltm"]
+
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "excel_file",
         type=str,
-        help="This is a Excel file. (Supported formats are: .xlsx,.xlsm,.xltx,.xltm. And wildcards cannot be used. )"
+        help="This is a Excel file or dir. (Supported formats are: .xlsx,.xlsm,.xltx,.xltm. And wildcards cannot be used. )"
     )
     parser.add_argument(
         "dest_dir",
@@ -18,35 +26,208 @@ def create_parser():
         default=None,
         help="This is a destination dir."
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes. With --stream the sheets are shared out, otherwise the books. Default is the number of CPUs."
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read rows lazily and write them straight out, for sheets too big to load. Keeps values, formulas and number formats. "
+             "Drops fonts, fills, borders, alignment, merged cells, column widths, row heights, comments, hyperlinks, "
+             "data validation, conditional formatting, images, charts, freeze panes, print settings and defined names."
+    )
+    parser.add_argument(
+        "--rows-per-file",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Split each sheet into files of N rows plus the first row as header, named SHEET_1, SHEET_2, ... Implies --stream."
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="xlsx",
+        choices=["xlsx", "csv", "tsv"],
+        help="Output format. csv and tsv are UTF-8 with the cached values of formulas, and imply --stream. Default is xlsx."
+    )
     return parser
 
-def split(excel_file, dest_dir):
+def split(excel_file, dest_dir, titles=None, stream=False, rows_per_file=0, fmt="xlsx"):
+    ######### Writes the sheets named in titles, or all sheets, and returns the file names.
+    stream = stream or rows_per_file > 0 or fmt != "xlsx"
+    book = openpyxl.load_workbook(excel_file, read_only=stream, data_only=fmt != "xlsx")
     try:
-        book = openpyxl.load_workbook(excel_file)
-        print("EXCEL FILE: " + excel_file)
+        file_names = []
         for sheet in book:
-            file_name = dest_dir + "/" + sheet.title + ".xlsx"
-            print(file_name)
-            new_book = copy.deepcopy(book)
-            for new_sheet in new_book:
-                if new_sheet.title == sheet.title:
-                    continue
-                else:
-                    new_book.remove(new_sheet)
-            new_book.save(file_name)
+            if titles is not None and sheet.title not in titles:
+                continue
+            if stream:
+                file_names.extend(stream_sheet(sheet, dest_dir, rows_per_file, fmt))
+            else:
+                file_name = dest_dir + "/" + sheet.title + ".xlsx"
+                save_sheet(book, sheet, file_name)
+                file_names.append(file_name)
+        return file_names
+    finally:
         book.close()
-        print("COMPLETE!")
-    except:
-        print("ERROR:")
-        print(sys.exc_info()[1])
-        sys.exit(1)
+
+def split_unit(unit, **options):
+    excel_file, dest_dir, titles = unit
+    try:
+        return split(excel_file, dest_dir, titles, **options), None
+    except Exception as e:
+        return None, e
+
+def work_units(files, dest_dir, jobs, stream=False, rows_per_file=0, fmt="xlsx", subdirs=False):
+    ######### (excel_file, dest_dir, sheet titles or None). With --stream a worker opens the book
+    ######### read_only and parses only its own sheet, so every sheet is a unit. Otherwise a worker
+    ######### has to load the whole book, so every book is one unit.
+    stream = stream or rows_per_file > 0 or fmt != "xlsx"
+    jobs = jobs or 1
+    units = []
+    for excel_file, book_dir in zip(files, book_dirs(files, dest_dir, subdirs)):
+        os.makedirs(book_dir, exist_ok=True)
+        if jobs <= 1 or not stream:
+            units.append((excel_file, book_dir, None))
+            continue
+        try:
+            book = openpyxl.load_workbook(excel_file, read_only=True)
+            titles = [sheet.title for sheet in book]
+            book.close()
+        except Exception:
+            ######### The worker reports the error for this book.
+            units.append((excel_file, book_dir, None))
+            continue
+        units.extend([(excel_file, book_dir, [title]) for title in titles] or [(excel_file, book_dir, None)])
+    return units
+
+def book_dirs(files, dest_dir, subdirs=False):
+    ######### Books from a directory get their own sub directory, since sheet names repeat.
+    ######### a.xlsx and a.xlsm keep the extension, so they do not write into the same one.
+    if not subdirs:
+        return [dest_dir] * len(files)
+    stems = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    return [os.path.join(dest_dir, stem if stems.count(stem) == 1 else os.path.basename(f)) for f, stem in zip(files, stems)]
+
+def split_all(files, dest_dir, jobs, subdirs=False, **options):
+    units = work_units(files, dest_dir, jobs, subdirs=subdirs, **options)
+    work = partial(split_unit, **options)
+    if jobs is None or jobs <= 1 or len(units) <= 1:
+        return report(units, map(work, units))
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(units))) as executor:
+        return report(units, executor.map(work, units))
+
+def report(units, results):
+    failed = []
+    last = None
+    for (excel_file, book_dir, titles), (file_names, error) in zip(units, results):
+        if excel_file != last:
+            print("EXCEL FILE: " + excel_file)
+            last = excel_file
+        if error is not None:
+            print("ERROR: {0}: {1}: {2}".format(excel_file, type(error).__name__, error))
+            if excel_file not in failed:
+                failed.append(excel_file)
+            continue
+        for file_name in file_names:
+            print(file_name)
+    return failed
+
+def save_sheet(book, sheet, file_name):
+    ######### The book is saved with only this sheet in it. Copying the whole book for
+    ######### every sheet made splitting O(sheets^2) in time.
+    sheets, names, active, state = book._sheets, book.defined_names, book._active_sheet_index, sheet.sheet_state
+    try:
+        book.defined_names = sheet_names(names, sheets.index(sheet), sheet.title)
+        book._sheets = [sheet]
+        book.active = 0
+        ######### A book needs one visible sheet.
+        sheet.sheet_state = "visible"
+        book.save(file_name)
+    finally:
+        book._sheets, book.defined_names, book._active_sheet_index, sheet.sheet_state = sheets, names, active, state
+
+def stream_sheet(sheet, dest_dir, rows_per_file=0, fmt="xlsx"):
+    ######### read_only in, write_only or csv out: one row is in memory at a time.
+    ######### Yields each file name before the file is written.
+    ######### The <dimension> some writers store is wrong, so rows are read to the real end.
+    sheet.reset_dimensions()
+    rows = sheet.iter_rows()
+    if rows_per_file <= 0:
+        file_name = dest_dir + "/" + sheet.title + "." + fmt
+        yield file_name
+        write_rows(file_name, sheet.title, fmt, rows)
+        return
+
+    header = next(rows, ())
+    for part in itertools.count(1):
+        chunk = itertools.islice(rows, rows_per_file)
+        first = next(chunk, None)
+        if first is None and part > 1:
+            return
+        file_name = dest_dir + "/" + sheet.title + "_%d." % part + fmt
+        yield file_name
+        write_rows(file_name, sheet.title, fmt, itertools.chain([header], [] if first is None else [first], chunk))
+
+def write_rows(file_name, title, fmt, rows):
+    if fmt == "xlsx":
+        new_book = openpyxl.Workbook(write_only=True)
+        new_sheet = new_book.create_sheet(title)
+        for row in rows:
+            new_sheet.append([stream_cell(new_sheet, cell) for cell in row])
+        new_book.save(file_name)
+        return
+
+    with open(file_name, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, delimiter="," if fmt == "csv" else "\t")
+        width = None
+        for row in rows:
+            values = ["" if cell.value is None else cell.value for cell in row]
+            ######### Rows are as long as their last stored cell. The first row sets the minimum width.
+            width = len(values) if width is None else width
+            writer.writerow(values + [""] * (width - len(values)))
+
+def stream_cell(sheet, cell):
+    if cell.value is None or cell.number_format == "General":
+        return cell.value
+    new_cell = WriteOnlyCell(sheet, cell.value)
+    new_cell.number_format = cell.number_format
+    return new_cell
+
+def sheet_names(names, index, title):
+    ######### Workbook names that point into other sheets would be #REF! in the new file.
+    def keep(name):
+        return all(sheet == title for sheet, cells in name.destinations)
+
+    result = type(names)()
+    if isinstance(names, dict):
+        ######### openpyxl 3.1 keeps the sheet's local names on the sheet itself.
+        result.update((key, name) for key, name in names.items() if keep(name))
+        return result
+
+    for name in names.definedName:
+        if name.localSheetId is None and keep(name):
+            result.append(name)
+        elif name.localSheetId == index:
+            name = copy.copy(name)
+            name.localSheetId = 0
+            result.append(name)
+    return result
 
 
 def main():
     parser = create_parser()
     args = parser.parse_args()
 
-    if not os.path.isfile(args.excel_file):
+    if os.path.isfile(args.excel_file):
+        files = [args.excel_file]
+    elif os.path.isdir(args.excel_file):
+        files = sorted(f for ext in EXCEL_EXTS for f in glob.glob(args.excel_file + "/*" + ext))
+    else:
         print("ERROR: Excel file does not exist.")
         sys.exit(1)
     
@@ -61,7 +242,16 @@ def main():
         print("ERROR: dest_dir is " + e.filename)
         sys.exit(1)
     
-    split(args.excel_file, dest_dir)
+    if args.rows_per_file < 0:
+        print("ERROR: --rows-per-file must be 0 or more.")
+        sys.exit(1)
+
+    options = dict(stream=args.stream, rows_per_file=args.rows_per_file, fmt=args.format)
+    failed = split_all(files, dest_dir, args.jobs, os.path.isdir(args.excel_file), **options)
+    if failed:
+        print("ERROR: %d of %d files failed." % (len(failed), len(files)))
+        sys.exit(1)
+    print("COMPLETE!")
 
 
 if __name__ == '__main__':
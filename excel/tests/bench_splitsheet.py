@@ -0,0 +1,84 @@
+import os
+import sys
+import copy
+import time
+import shutil
+import tempfile
+import tracemalloc
+import openpyxl
+from openpyxl.styles import Font, PatternFill
+from openpyxl.workbook.defined_name import DefinedName
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from splitsheet import save_sheet
+
+
+def make_book(path, sheets, rows, cols):
+    ######### Styled cells, merged ranges, dimensions and a name per sheet, like our monthly reports.
+    book = openpyxl.Workbook()
+    book.remove(book.active)
+    bold = Font(bold=True)
+    fill = PatternFill("solid", fgColor="FFEEAA")
+    for s in range(sheets):
+        sheet = book.create_sheet("S%02d" % s)
+        for r in range(1, rows + 1):
+            sheet.append([r * c for c in range(cols)])
+        for c in range(1, cols + 1):
+            sheet.cell(1, c).font = bold
+            sheet.cell(1, c).fill = fill
+        sheet.merge_cells("A%d:C%d" % (rows + 2, rows + 2))
+        sheet.column_dimensions["A"].width = 20
+        sheet.row_dimensions[1].height = 30
+        name = DefinedName("total_%02d" % s, attr_text="'S%02d'!$A$1:$A$%d" % (s, rows))
+        if isinstance(book.defined_names, dict):
+            book.defined_names[name.name] = name
+        else:
+            book.defined_names.append(name)
+    book.save(path)
+
+def deepcopy_split(book, dest_dir):
+    for sheet in book:
+        new_book = copy.deepcopy(book)
+        for new_sheet in new_book:
+            if new_sheet.title != sheet.title:
+                new_book.remove(new_sheet)
+        new_book.save(os.path.join(dest_dir, sheet.title + ".xlsx"))
+
+def single_split(book, dest_dir):
+    for sheet in book:
+        save_sheet(book, sheet, os.path.join(dest_dir, sheet.title + ".xlsx"))
+
+def bench(split, path, trace=False):
+    ######### tracemalloc slows openpyxl down a lot, so time and memory are separate runs.
+    dest_dir = tempfile.mkdtemp()
+    try:
+        if trace: tracemalloc.start()
+        start = time.perf_counter()
+        split(openpyxl.load_workbook(path), dest_dir)
+        elapsed = time.perf_counter() - start
+        if trace:
+            elapsed = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return elapsed
+    finally:
+        shutil.rmtree(dest_dir)
+
+
+def main():
+    # ex.) python bench_splitsheet.py 20 300 10
+    sheets = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    cols = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "book.xlsx")
+        make_book(path, sheets, rows, cols)
+        print("Book: %d sheets x %d rows x %d cols" % (sheets, rows, cols))
+        old_time, new_time = bench(deepcopy_split, path), bench(single_split, path)
+        old_peak, new_peak = bench(deepcopy_split, path, True), bench(single_split, path, True)
+        print("deepcopy per sheet: %.2f s, peak %.1f MB" % (old_time, old_peak / 2 ** 20))
+        print("single pass       : %.2f s, peak %.1f MB  (%.1fx faster)" % (new_time, new_peak / 2 ** 20, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
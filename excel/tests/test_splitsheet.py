@@ -0,0 +1,268 @@
+import pytest
+import os
+import sys
+import re
+import zipfile
+import datetime
+import csv
+import openpyxl
+from openpyxl.styles import Font
+from openpyxl.workbook.defined_name import DefinedName
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from splitsheet import (
+    split,
+    save_sheet,
+    sheet_names,
+    stream_sheet,
+    split_all,
+    work_units,
+    book_dirs,
+)
+
+
+def make_book(path, titles, rows=3):
+    book = openpyxl.Workbook()
+    book.remove(book.active)
+    for title in titles:
+        sheet = book.create_sheet(title)
+        for r in range(1, rows + 1):
+            sheet.append([title, r, r * 10])
+    book.save(path)
+    return str(path)
+
+@pytest.fixture
+def books(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    return [make_book(src / "a.xlsx", ["S1", "S2", "S3"]), make_book(src / "b.xlsx", ["S1"])]
+
+@pytest.mark.parametrize('jobs', [1, 4, 64])
+def test_work_units_full(books, tmp_path, jobs):
+    # Without --stream every unit loads the whole book, so a book is never cut up.
+    units = work_units(books, str(tmp_path / "out"), jobs, subdirs=True)
+    assert units == [
+        (books[0], str(tmp_path / "out" / "a"), None),
+        (books[1], str(tmp_path / "out" / "b"), None),
+    ]
+
+@pytest.mark.parametrize('options', [dict(stream=True), dict(rows_per_file=2), dict(fmt="csv")])
+def test_work_units_stream(books, tmp_path, options):
+    units = work_units(books, str(tmp_path / "out"), 4, subdirs=True, **options)
+    assert units == [
+        (books[0], str(tmp_path / "out" / "a"), ["S1"]),
+        (books[0], str(tmp_path / "out" / "a"), ["S2"]),
+        (books[0], str(tmp_path / "out" / "a"), ["S3"]),
+        (books[1], str(tmp_path / "out" / "b"), ["S1"]),
+    ]
+
+def test_work_units_stream_serial(books, tmp_path):
+    units = work_units(books, str(tmp_path), 1, stream=True)
+    assert units == [(books[0], str(tmp_path), None), (books[1], str(tmp_path), None)]
+
+def test_work_units_bad_book(tmp_path):
+    bad = tmp_path / "bad.xlsx"
+    bad.write_bytes(b"not a book")
+    assert work_units([str(bad)], str(tmp_path), 4, stream=True) == [(str(bad), str(tmp_path), None)]
+
+@pytest.mark.parametrize(('files', 'subdirs', 'expected'), [
+    (["d/a.xlsx"], False, ["out"]),
+    (["d/a.xlsx", "d/b.xlsx"], False, ["out", "out"]),
+    # A directory with one book still gets a sub directory.
+    (["d/a.xlsx"], True, ["out/a"]),
+    (["d/a.xlsx", "d/b.xlsm"], True, ["out/a", "out/b"]),
+    (["d/a.xlsm", "d/a.xlsx", "d/b.xlsx"], True, ["out/a.xlsm", "out/a.xlsx", "out/b"]),
+])
+def test_book_dirs(files, subdirs, expected):
+    assert book_dirs(files, "out", subdirs) == expected
+
+def test_split_all_same_stem(tmp_path, capsys):
+    src = tmp_path / "src"
+    src.mkdir()
+    files = [make_book(src / "a.xlsm", ["S1"]), make_book(src / "a.xlsx", ["S1"])]
+    dst = tmp_path / "dst"
+
+    assert split_all(files, str(dst), 1, True) == []
+    for name in ["a.xlsm", "a.xlsx"]:
+        book = openpyxl.load_workbook(dst / name / "S1.xlsx")
+        assert book.sheetnames == ["S1"]
+    assert capsys.readouterr().out.splitlines() == [
+        "EXCEL FILE: " + files[0],
+        str(dst / "a.xlsm" / "S1.xlsx"),
+        "EXCEL FILE: " + files[1],
+        str(dst / "a.xlsx" / "S1.xlsx"),
+    ]
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_split_all_failure(books, tmp_path, capsys, jobs):
+    bad = tmp_path / "src" / "c.xlsx"
+    bad.write_bytes(b"not a book")
+    files = books + [str(bad)]
+
+    failed = split_all(files, str(tmp_path / "dst"), jobs, True, stream=True)
+
+    assert failed == [str(bad)]
+    assert sorted(os.listdir(tmp_path / "dst" / "a")) == ["S1.xlsx", "S2.xlsx", "S3.xlsx"]
+    assert capsys.readouterr().out.splitlines()[-1].startswith("ERROR: " + str(bad) + ": ")
+
+
+class NameList:
+    # openpyxl 3.0 keeps all names in one list, sheet local ones with localSheetId.
+    def __init__(self, names=()):
+        self.definedName = list(names)
+
+    def append(self, name):
+        self.definedName.append(name)
+
+def test_sheet_names_dict():
+    names = {
+        "own": DefinedName("own", attr_text="'S2'!$A$1:$A$3"),
+        "other": DefinedName("other", attr_text="'S1'!$A$1"),
+        "both": DefinedName("both", attr_text="'S1'!$A$1,'S2'!$A$1"),
+        "constant": DefinedName("constant", attr_text="42"),
+    }
+    result = sheet_names(names, 1, "S2")
+    assert type(result) is dict
+    assert sorted(result) == ["constant", "own"]
+
+def test_sheet_names_list():
+    own = DefinedName("own", attr_text="'S2'!$A$1")
+    other = DefinedName("other", attr_text="'S1'!$A$1")
+    local = DefinedName("local", attr_text="'S2'!$B$1", localSheetId=1)
+    foreign = DefinedName("foreign", attr_text="'S1'!$B$1", localSheetId=0)
+    names = NameList([own, other, local, foreign])
+
+    result = sheet_names(names, 1, "S2")
+
+    assert type(result) is NameList
+    assert [(n.name, n.localSheetId) for n in result.definedName] == [("own", None), ("local", 0)]
+    # The loaded book is not changed.
+    assert local.localSheetId == 1
+
+def test_split(tmp_path):
+    book = openpyxl.Workbook()
+    book.remove(book.active)
+    for title in ["S1", "S2", "S3"]:
+        sheet = book.create_sheet(title)
+        sheet.append([title, 1, 2])
+        sheet["A1"].font = Font(bold=True)
+        sheet.column_dimensions["A"].width = 25
+        sheet.merge_cells("B2:C2")
+    book["S3"].sheet_state = "hidden"
+    book.defined_names["s1_total"] = DefinedName("s1_total", attr_text="'S1'!$B$1:$C$1")
+    book.defined_names["s2_total"] = DefinedName("s2_total", attr_text="'S2'!$B$1:$C$1")
+    book.active = 1
+    path = str(tmp_path / "book.xlsx")
+    book.save(path)
+
+    assert split(path, str(tmp_path)) == [str(tmp_path / t) + ".xlsx" for t in ["S1", "S2", "S3"]]
+    for title in ["S1", "S2", "S3"]:
+        result = openpyxl.load_workbook(tmp_path / (title + ".xlsx"))
+        sheet = result.active
+        assert result.sheetnames == [title]
+        assert sheet.sheet_state == "visible"
+        assert [c.value for c in sheet[1]] == [title, 1, 2]
+        assert sheet["A1"].font.bold
+        assert sheet.column_dimensions["A"].width == 25
+        assert [str(r) for r in sheet.merged_cells.ranges] == ["B2:C2"]
+        assert sorted(result.defined_names) == {"S1": ["s1_total"], "S2": ["s2_total"], "S3": []}[title]
+
+def test_save_sheet_restores_book(tmp_path):
+    path = make_book(tmp_path / "book.xlsx", ["S1", "S2"])
+    book = openpyxl.load_workbook(path)
+    book["S2"].sheet_state = "hidden"
+    book.active = 0
+    names = book.defined_names
+
+    save_sheet(book, book["S2"], str(tmp_path / "S2.xlsx"))
+
+    assert book.sheetnames == ["S1", "S2"]
+    assert book["S2"].sheet_state == "hidden"
+    assert book.active.title == "S1"
+    assert book.defined_names is names
+
+def stale_dimension(path):
+    # Some writers store <dimension ref="A1"/> for a filled sheet.
+    with zipfile.ZipFile(path) as z:
+        files = {name: z.read(name) for name in z.namelist()}
+    for name in files:
+        if name.startswith("xl/worksheets/sheet"):
+            files[name] = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="A1"', files[name])
+    with zipfile.ZipFile(path, "w") as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+
+def test_split_stream(tmp_path):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = "Data"
+    sheet.append(["name", "price", "date", "total"])
+    for r in range(2, 6):
+        sheet.append(["item%d" % r, r * 1.5, datetime.datetime(2024, 1, r), "=B%d*2" % r])
+        sheet.cell(r, 2).number_format = "0.00"
+        sheet.cell(r, 3).number_format = "yyyy-mm-dd"
+    book.create_sheet("Empty")
+    path = str(tmp_path / "book.xlsx")
+    book.save(path)
+    stale_dimension(path)
+
+    assert split(path, str(tmp_path), stream=True) == [str(tmp_path / "Data.xlsx"), str(tmp_path / "Empty.xlsx")]
+
+    full = openpyxl.load_workbook(path)["Data"]
+    result = openpyxl.load_workbook(tmp_path / "Data.xlsx")["Data"]
+    assert result.max_row == 5
+    for row, expected in zip(result.iter_rows(), full.iter_rows()):
+        assert [c.value for c in row] == [c.value for c in expected]
+        assert [c.number_format for c in row] == [c.number_format for c in expected]
+    assert result["D3"].value == "=B3*2"
+    assert openpyxl.load_workbook(tmp_path / "Empty.xlsx").sheetnames == ["Empty"]
+
+def read_rows(path, fmt):
+    if fmt == "xlsx":
+        return [[c.value for c in row] for row in openpyxl.load_workbook(path).active.iter_rows()]
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f, delimiter="," if fmt == "csv" else "\t"))
+
+@pytest.mark.parametrize('fmt', ["xlsx", "csv", "tsv"])
+@pytest.mark.parametrize(('data_rows', 'rows_per_file', 'parts'), [
+    (5, 2, [[2, 3], [4, 5], [6]]),
+    (4, 2, [[2, 3], [4, 5]]),
+    (3, 10, [[2, 3, 4]]),
+    (1, 1, [[2]]),
+    (0, 3, [[]]),
+])
+def test_stream_sheet_chunks(tmp_path, fmt, data_rows, rows_per_file, parts):
+    path = make_book(tmp_path / "book.xlsx", ["S"], data_rows + 1)
+    book = openpyxl.load_workbook(path, read_only=True)
+    names = list(stream_sheet(book["S"], str(tmp_path), rows_per_file, fmt))
+    book.close()
+
+    assert names == [str(tmp_path / ("S_%d.%s" % (i, fmt))) for i in range(1, len(parts) + 1)]
+    for name, part in zip(names, parts):
+        # Every part starts with the first row of the sheet.
+        expected = [["S", 1, 10]] + [["S", r, r * 10] for r in part]
+        if fmt != "xlsx":
+            expected = [[str(v) for v in row] for row in expected]
+        assert read_rows(name, fmt) == expected
+
+@pytest.mark.parametrize('fmt', ["csv", "tsv"])
+def test_split_csv(tmp_path, fmt):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = "S"
+    sheet.append(["a", "b", "c"])
+    sheet.append(["tab\there", "comma, \"quoted\"", None])
+    sheet.append([1])
+    sheet.append(["日本語", 2.5, "x", "extra"])
+    path = str(tmp_path / "book.xlsx")
+    book.save(path)
+
+    assert split(path, str(tmp_path), fmt=fmt) == [str(tmp_path / ("S." + fmt))]
+    # Short rows are padded to the first row; longer rows are kept.
+    assert read_rows(str(tmp_path / ("S." + fmt)), fmt) == [
+        ["a", "b", "c"],
+        ["tab\there", "comma, \"quoted\"", ""],
+        ["1", "", ""],
+        ["日本語", "2.5", "x", "extra"],
+    ]
@@ -0,0 +1,121 @@
+import os
+import sys
+import argparse
+import glob
+from functools import partial
+from PIL import Image
+from transparent import transparent, threshold_value, report
+from resize import resize_image, get_filter, check_size
+from pool import map_files
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "source",
+        type=str,
+        help="This is source file or dir. (Specify a file or directory. Wildcards cannot be used.)"
+    )
+    parser.add_argument(
+        "dest_dir",
+        type=str,
+        nargs="?",
+        default=None,
+        help="This is destination dir."
+    )
+    parser.add_argument(
+        "-t", "--threshold",
+        type=threshold_value,
+        default=250,
+        help="The brightness of the pixel is the threshold. Brightness is the average of rgb. Default is 250."
+    )
+    parser.add_argument(
+        "-s", "--size",
+        type=str,
+        default="300",
+        help="This is size parameter. ex.) 800, 600x400, 350x240!, 450x, x400 etc. Default is 300."
+    )
+    parser.add_argument(
+        "-f", "--filter",
+        type=str,
+        default="LANCZOS",
+        choices=["NEAREST", "BOX", "BILINEAR", "HAMMING", "BICUBIC", "LANCZOS"],
+        help="This is filter parameter. Default is LANCZOS."
+    )
+    parser.add_argument(
+        "-T", "--thumbnail",
+        action="store_true",
+        help="This is thumbnail option. Fixed aspect ratio."
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used when source is a directory. Default is the number of CPUs."
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Give more output."
+    )
+    return parser
+
+def hanko(img, threshold, arg_size, resample, thumbnail):
+    ######### transparent.py -> resize.py, without writing and re-reading the PNG in between.
+    img = transparent(img.convert("RGB"), threshold)
+    result = resize_image(img, arg_size, resample, thumbnail)
+    return img if result is None else result[0]
+
+def hanko_file(f, dst_dir, threshold, arg_size, resample, thumbnail):
+    try:
+        root, ext = os.path.splitext(f)
+        file_name = os.path.basename(root)
+        with Image.open(f) as img:
+            hanko(img, threshold, arg_size, resample, thumbnail).save(os.path.join(dst_dir, file_name + ".png"))
+        return dst_dir + "/" + file_name + ".png", None
+    except Exception as e:
+        return None, e
+
+def hanko_all(files, dst_dir, verbose, jobs, **options):
+    work = partial(hanko_file, dst_dir=dst_dir, **options)
+    results = map_files(work, files, jobs)
+    return [f for f, result in zip(files, results) if not report(f, result, verbose, "Hanko")]
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    options = dict(
+        threshold=args.threshold,
+        arg_size=args.size,
+        resample=get_filter(args.filter),
+        thumbnail=args.thumbnail,
+    )
+
+    dest_dir = "." if args.dest_dir is None else args.dest_dir
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+    except FileExistsError as e:
+        print("ERROR: dest_dir is " + e.filename)
+        sys.exit(1)
+
+    if not check_size(args.size, args.thumbnail):
+        print("ERROR: Invalid size option.")
+        sys.exit(1)
+
+    if os.path.isfile(args.source):
+        files = [args.source]
+    elif os.path.isdir(args.source):
+        files = sorted(glob.glob(args.source + "/*"))
+    else:
+        print("ERROR: Source file or dir does not exist.")
+        sys.exit(1)
+
+    failed = hanko_all(files, dest_dir, args.verbose, args.jobs, **options)
+    if failed:
+        print("ERROR: %d of %d files failed." % (len(failed), len(files)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
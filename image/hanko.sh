@@ -1,4 +1,2 @@
 #!/bin/zsh
-time python transparent.py images transparent_images -v
-#cp -fv ./transparent_images/* ./images/
-time python resize.py transparent_images resize_images -vf LANCZOS -s 300
\ No newline at end of file
+time python hanko.py images resize_images -vf LANCZOS -s 300
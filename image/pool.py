@@ -0,0 +1,12 @@
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_files(work, files, jobs):
+    ######### Results come back in input order, so output matches a serial run.
+    if jobs is None or jobs <= 1 or len(files) <= 1:
+        yield from map(work, files)
+        return
+
+    chunksize = max(1, min(64, len(files) // (jobs * 4)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(work, files, chunksize=chunksize)
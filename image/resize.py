@@ -3,8 +3,15 @@ import sys
 import argparse
 import glob
 import re
+import csv
+import json
+import math
+from collections import namedtuple
+from functools import partial
+from types import SimpleNamespace
 from PIL import Image
 from decimal import Decimal, getcontext, FloatOperation, ROUND_HALF_UP
+from pool import map_files
 
 getcontext().traps[FloatOperation] = True
 
@@ -26,8 +33,14 @@ def create_parser():
     parser.add_argument(
         "-s", "--size",
         type=str,
+        action="append",
         required=True,
-        help="This is size parameter. ex.) 800, 600x400, 350x240!, 450x, x400 etc."
+        help="This is size parameter. ex.) 800, 600x400, 350x240!, 450x, x400 etc. Repeat it to write several sizes from one decode, each into a subdir named after the size."
+    )
+    parser.add_argument(
+        "-S", "--suffix",
+        action="store_true",
+        help="With several sizes, add the size to the file name instead of using subdirs. ex.) photo_800x.jpg"
     )
     parser.add_argument(
         "-f", "--filter",
@@ -40,6 +53,26 @@ def create_parser():
         action="store_true",
         help="This is thumbnail option. Fixed aspect ratio."
     )
+    parser.add_argument(
+        "-r", "--reducing-gap",
+        type=reducing_gap_value,
+        nargs="?",
+        const=3.0,
+        default=None,
+        help="Fast downscale. JPEG is decoded at a reduced scale and the image is reduced by an integer factor before the filter is applied, keeping at least this many times the target size. Default gap is 3.0."
+    )
+    parser.add_argument(
+        "-P", "--plan",
+        type=str,
+        choices=["json", "csv"],
+        help="Dry run. Read only the image headers and print the size and action (resize, thumbnail, skip, error) of each file. Nothing is written."
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used when source is a directory. Default is the number of CPUs."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -47,83 +80,292 @@ def create_parser():
     )
     return parser
 
+def reducing_gap_value(s):
+    try:
+        value = float(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("number expected, got " + repr(s))
+    if not 1.0 <= value < float("inf"):
+        raise argparse.ArgumentTypeError("REDUCING_GAP >= 1.0 expected, got " + repr(s))
+    return value
+
+
+def resize(f, arg_size, dest_dir, resample, thumbnail, verbose, reducing_gap=None):
+    return report(f, resize_file(f, arg_size, dest_dir, resample, thumbnail, reducing_gap), thumbnail, verbose)
+
+def resize_file(f, arg_size, dest_dir, resample, thumbnail, reducing_gap=None):
+    try: ######### File open
+        with Image.open(f) as img:
+            result = resize_image(img, arg_size, resample, thumbnail, reducing_gap)
+            if result is None:
+                return None, None
+
+            root, ext = os.path.splitext(f)
+            file_name = os.path.basename(root)
+            img_resize, (width, height) = result
+            img_resize.save(os.path.join(dest_dir, file_name + ext))
+            return (width, height, dest_dir + "/" + file_name + ext), None
+
+    except Exception as e:
+        return None, e
 
-def resize(f, arg_size, dest_dir, resample, thumbnail, verbose):
+def renditions_file(f, sizes, dest_dir, resample, thumbnail, reducing_gap=None, suffix=False):
+    try: ######### File open
+        with Image.open(f) as img:
+            root, ext = os.path.splitext(f)
+            file_name = os.path.basename(root)
+            outputs = []
+            for arg_size, result in zip(sizes, renditions(img, sizes, resample, thumbnail, reducing_gap)):
+                if result is None:
+                    outputs.append(None)
+                    continue
+
+                out_dir, out_name = rendition_path(dest_dir, file_name, arg_size, suffix)
+                img_resize, (width, height) = result
+                img_resize.save(os.path.join(out_dir, out_name + ext))
+                outputs.append((width, height, out_dir + "/" + out_name + ext))
+            return outputs, None
+
+    except Exception as e:
+        return None, e
+
+RENDITION_TOKENS = {">": "gt", "<": "lt", "^": "fill"}
+
+def rendition_label(arg_size):
+    if isinstance(arg_size, SizePlan):
+        arg_size = arg_size.arg_size
+    label = "".join(RENDITION_TOKENS.get(c, c) for c in arg_size.lower())
+    return re.sub(r"[^\w%.!-]", "_", label)
+
+def rendition_path(dest_dir, file_name, arg_size, suffix):
+    label = rendition_label(arg_size)
+    if suffix:
+        return dest_dir, file_name + "_" + label
+    return os.path.join(dest_dir, label), file_name
+
+def report(f, result, thumbnail, verbose):
+    output, error = result
+    if error is not None:
+        print("Error: ", f)
+        return False
+
+    for out in output if isinstance(output, list) else [output]:
+        if out is None:
+            if verbose: print("Non operation: ", f)
+        elif verbose:
+            width, height, path = out
+            mode = "Thumbnail" if thumbnail else "Resize"
+            print("Success <%s> <%sx%s>: " % (mode, width, height) + path)
+    return True
+
+def resize_all(files, sizes, dest_dir, resample, thumbnail, verbose, jobs, reducing_gap=None, suffix=False):
+    if len(sizes) == 1:
+        work = partial(resize_file, arg_size=sizes[0], dest_dir=dest_dir, resample=resample, thumbnail=thumbnail, reducing_gap=reducing_gap)
+    else:
+        work = partial(renditions_file, sizes=sizes, dest_dir=dest_dir, resample=resample, thumbnail=thumbnail, reducing_gap=reducing_gap, suffix=suffix)
+    results = map_files(work, files, jobs)
+    return [(f, r[1]) for f, r in zip(files, results) if not report(f, r, thumbnail, verbose)]
+
+def resize_image(img, arg_size, resample, thumbnail, reducing_gap=None):
+    size = target_size(img, arg_size, thumbnail)
+    if size is None:
+        return None
+
+    width, height = size
+    if thumbnail:
+        img.thumbnail((width, height), resample)
+        return img, (width, height)
+    elif reducing_gap is None:
+        return img.resize((int(width), int(height)), resample), (width, height)
+    else:
+        ######### Size is already fixed from the full dimensions, draft() only changes the decode scale.
+        img.draft(None, (int(width * Decimal(str(reducing_gap))), int(height * Decimal(str(reducing_gap)))))
+        return img.resize((int(width), int(height)), resample, reducing_gap=reducing_gap), (width, height)
+
+def plan_report(files, sizes, dest_dir, suffix=False):
+    ######### Header only, Image.open() does not decode pixels.
+    rows = []
+    for f in files:
+        root, ext = os.path.splitext(f)
+        file_name = os.path.basename(root)
+        try:
+            with Image.open(f) as img:
+                width, height = img.size
+        except Exception as e:
+            rows.append(dict(file=f, width=None, height=None, size=None, target_width=None,
+                             target_height=None, action="error", output=None, error=str(e)))
+            continue
+
+        header = SimpleNamespace(width=width, height=height)
+        for plan in sizes:
+            row = dict(file=f, width=width, height=height, size=plan.arg_size, target_width=None,
+                       target_height=None, action="skip", output=None, error=None)
+            try:
+                size = target_size(header, plan, plan.thumbnail)
+            except ValueError as e:
+                row.update(action="error", error=str(e))
+                rows.append(row)
+                continue
+
+            if size is not None:
+                if len(sizes) == 1:
+                    out_dir, out_name = dest_dir, file_name
+                else:
+                    out_dir, out_name = rendition_path(dest_dir, file_name, plan, suffix)
+                row.update(target_width=int(size[0]), target_height=int(size[1]),
+                           action="thumbnail" if plan.thumbnail else "resize",
+                           output=out_dir + "/" + out_name + ext)
+            rows.append(row)
+    return rows
+
+def print_plan(rows, fmt):
+    if fmt == "json":
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=["file", "width", "height", "size", "target_width",
+                                                        "target_height", "action", "output", "error"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+def renditions(img, sizes, resample, thumbnail, reducing_gap=None):
+    ######### All sizes come from the original dimensions, like separate runs. Pixels
+    ######### come from the smallest earlier rendition that is still at least twice
+    ######### as large and has the original aspect ratio, otherwise from the original.
+    targets = [target_size(img, arg_size, thumbnail) for arg_size in sizes]
+    wanted = [size for size in targets if size is not None]
+    if reducing_gap is not None and wanted and not thumbnail:
+        gap = Decimal(str(reducing_gap))
+        img.draft(None, (int(max(w for w, h in wanted) * gap), int(max(h for w, h in wanted) * gap)))
+
+    results = [None] * len(sizes)
+    done = []
+    order = sorted((i for i, size in enumerate(targets) if size is not None), key=lambda i: targets[i][0] * targets[i][1], reverse=True)
+    for i in order:
+        width, height = targets[i]
+        source = img
+        for prev in done:
+            if prev.width >= 2 * width and prev.height >= 2 * height:
+                source = prev
+
+        if thumbnail and source is img:
+            img_resize = source.copy()
+            img_resize.thumbnail((width, height), resample)
+        elif thumbnail:
+            ######### An earlier rendition has rounded pixels, so the size is taken from the original.
+            img_resize = source.resize(thumbnail_size(img.size, (width, height)), resample)
+        else:
+            img_resize = source.resize((int(width), int(height)), resample, reducing_gap=reducing_gap)
+
+        if abs(img_resize.width * img.height - img_resize.height * img.width) <= max(img.size):
+            done.append(img_resize)
+        results[i] = (img_resize, (width, height))
+    return results
+
+def thumbnail_size(size, box):
+    ######### The size Image.thumbnail() gives an image of this size.
+    width, height = size
+    x, y = map(math.floor, box)
+    if x >= width and y >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+SizePlan = namedtuple("SizePlan", ["arg_size", "op", "w_spec", "h_spec", "thumbnail"])
+
+def compile_size(arg_size, thumbnail) -> SizePlan:
+    ######### Parse the size option once. Only the dimension arithmetic is left per file.
     size_opt = arg_size.lower()
     x_pos = size_opt.find("x")
     width_str = size_opt[:x_pos]
     height_str= size_opt[x_pos + 1:]
-    non_ope = False
 
-    try: ######### File open
-        img = Image.open(f)
-        
-        try: ######### Size option check
-            w_spec = get_size(width_str, img.width)
-            h_spec = get_size(height_str, img.height)
-
-            if not thumbnail:
-                if x_pos == -1: ######### Width only
-                    w = get_size(size_opt, img.width)
-                    width, height = ref_width(w, img)
-
-                else: ############ Width & height
-
-                    if height_str == "": # Fixed aspect ratio
-                        width, height = ref_width(w_spec, img)
-                    
-                    elif width_str == "": # Fixed aspect ratio
-                        width, height = ref_height(h_spec, img)
-
-                    elif size_opt[-1] == "!": # Ignore aspect ratio
-                        width ,height = w_spec, h_spec
-
-                    elif size_opt[-1] == ">": # Fixed aspect ratio
-                        if img.width > w_spec and img.height > h_spec:
-                            width, height = adapt_size(size_opt, img)
-                        else:
-                            non_ope = True
-
-                    elif size_opt[-1] == "<": # Fixed aspect ratio
-                        if img.width < w_spec and img.height < h_spec:
-                            width, height = adapt_size(size_opt, img)
-                        else:
-                            non_ope = True
-
-                    elif size_opt[-1] == "^": # Fixed aspect ratio
-                        if img.width < img.height:
-                            width, height = ref_width(w_spec, img)
-                        else:
-                            width, height = ref_height(h_spec, img)
-
-                    else: # Fixed aspect ratio
-                        width, height = adapt_size(size_opt, img)
-
-        except:
-            print("ERROR: Invalid size option.")
-            sys.exit(1)
+    try: ######### Size option check
+        w_spec = parse_size(width_str)
+        h_spec = parse_size(height_str)
 
-        if non_ope and verbose:
-            print("Non operation: ", f)
-        
-        else:
-            root, ext = os.path.splitext(f)
-            file_name = os.path.basename(root)
+        if thumbnail:
+            op = "thumbnail"
+        elif x_pos == -1: ######### Width only
+            op = "width"
+            w_spec = parse_size(size_opt)
+        elif height_str == "": # Fixed aspect ratio
+            op = "ref_width"
+        elif width_str == "": # Fixed aspect ratio
+            op = "ref_height"
+        elif size_opt[-1] in "!><^":
+            op = size_opt[-1]
+        else: # Fixed aspect ratio
+            op = "adapt"
+
+    except Exception as e:
+        raise ValueError("Invalid size option: " + arg_size) from e
+
+    return SizePlan(arg_size, op, w_spec, h_spec, thumbnail)
+
+def as_plan(size, thumbnail) -> SizePlan:
+    return size if isinstance(size, SizePlan) else compile_size(size, thumbnail)
+
+def target_size(img, arg_size, thumbnail):
+    plan = as_plan(arg_size, thumbnail)
+
+    try:
+        w_spec = eval_size(plan.w_spec, img.width)
+        h_spec = eval_size(plan.h_spec, img.height)
+
+        if plan.op == "thumbnail":
+            width, height = int(w_spec), int(h_spec)
 
-            if thumbnail:
-                img.thumbnail((w_spec, h_spec), resample)
-                img.save(os.path.join(dest_dir, file_name + ext))
-                if verbose:
-                    print("Success <Thumbnail> <%sx%s>: " % (w_spec, h_spec) + dest_dir + "/" + file_name + ext)
+        elif plan.op in ("width", "ref_width"):
+            width, height = ref_width(w_spec, img)
+
+        elif plan.op == "ref_height":
+            width, height = ref_height(h_spec, img)
+
+        elif plan.op == "!": # Ignore aspect ratio
+            width ,height = w_spec, h_spec
+
+        elif plan.op == ">": # Fixed aspect ratio
+            if img.width > w_spec and img.height > h_spec:
+                width, height = fit_size(w_spec, h_spec, img)
             else:
-                img_resize = img.resize((int(width), int(height)), resample)
-                img_resize.save(os.path.join(dest_dir, file_name + ext))
-                if verbose:
-                    print("Success <Resize> <%sx%s>: " % (width, height) + dest_dir + "/" + file_name + ext)
+                return None
 
-    except OSError as e:
-        print("Error: ", f)
-        pass
+        elif plan.op == "<": # Fixed aspect ratio
+            if img.width < w_spec and img.height < h_spec:
+                width, height = fit_size(w_spec, h_spec, img)
+            else:
+                return None
+
+        elif plan.op == "^": # Fixed aspect ratio
+            if img.width < img.height:
+                width, height = ref_width(w_spec, img)
+            else:
+                width, height = ref_height(h_spec, img)
+
+        else: # Fixed aspect ratio
+            width, height = fit_size(w_spec, h_spec, img)
+
+    except Exception as e:
+        raise ValueError("Invalid size option: " + plan.arg_size) from e
+
+    return width, height
+
+def check_size(arg_size, thumbnail) -> bool:
+    ######### Validate the size option once, against a dummy 1000x1000 image.
+    try:
+        target_size(SimpleNamespace(width=1000, height=1000), arg_size, thumbnail)
+        return True
+    except ValueError:
+        return False
 
 def adapt_size(size_opt, img) -> tuple[Decimal, Decimal]:
     x_pos = size_opt.find("x")
@@ -131,7 +373,9 @@ def adapt_size(size_opt, img) -> tuple[Decimal, Decimal]:
     height_str= size_opt[x_pos + 1:]
     w_spec = get_size(width_str, img.width)
     h_spec = get_size(height_str, img.height)
+    return fit_size(w_spec, h_spec, img)
 
+def fit_size(w_spec, h_spec, img) -> tuple[Decimal, Decimal]:
     if img.width >= img.height:
         w_temp, h_temp = ref_width(w_spec, img)
         if h_temp > h_spec:
@@ -145,30 +389,32 @@ def adapt_size(size_opt, img) -> tuple[Decimal, Decimal]:
     return w_temp, h_temp
 
 def ref_width(w_spec, img) -> tuple[Decimal, Decimal]:
-    try:
-        height = round_halfup(img.height * w_spec / img.width)
-        return w_spec, height
-    except:
-        sys.exit(1)
+    height = round_halfup(img.height * w_spec / img.width)
+    return w_spec, height
 
 def ref_height(h_spec, img) -> tuple[Decimal, Decimal]:
-    try:
-        width = round_halfup(img.width * h_spec / img.height)
-        return width, h_spec
-    except:
-        sys.exit(1)
+    width = round_halfup(img.width * h_spec / img.height)
+    return width, h_spec
 
 def get_size(size_str, source_size) -> Decimal:
+    return eval_size(parse_size(size_str), source_size)
+
+def parse_size(size_str) -> tuple[str, Decimal]:
     if size_str == "": return
     scale = percent(size_str)
-    try:
-        if scale is None:
-            return Decimal("".join(filter(str.isdigit, size_str)))
-        else:
-            ratio = Decimal("".join(filter(lambda s:re.sub(r"[^\d.]", "", s), scale)))
-            return round_halfup(source_size * ratio / 100)
-    except:
-        sys.exit(1)
+    if scale is None:
+        return "px", Decimal("".join(filter(str.isdigit, size_str)))
+    else:
+        ratio = Decimal("".join(filter(lambda s:re.sub(r"[^\d.]", "", s), scale)))
+        return "%", ratio
+
+def eval_size(spec, source_size) -> Decimal:
+    if spec is None: return
+    unit, value = spec
+    if unit == "px":
+        return value
+    else:
+        return round_halfup(source_size * value / 100)
 
 def percent(s) -> str:
     unit_pos = s.find("%")
@@ -180,49 +426,79 @@ def percent(s) -> str:
 def round_halfup(decimal_value) -> Decimal:
     return decimal_value.quantize(Decimal('0'), rounding=ROUND_HALF_UP)
 
+def get_filter(filter_arg):
+    if filter_arg is None:
+        return Image.NEAREST
+    filter_arg = filter_arg.upper()
+    if filter_arg == "NEAREST":
+        return Image.NEAREST
+    elif filter_arg == "BOX":
+        return Image.BOX
+    elif filter_arg == "BILINEAR":
+        return Image.BILINEAR
+    elif filter_arg == "HAMMING":
+        return Image.HAMMING
+    elif filter_arg == "BICUBIC":
+        return Image.BICUBIC
+    elif filter_arg == "LANCZOS":
+        return Image.LANCZOS
+    else:
+        return Image.NEAREST
+
 
 def main():
     parser = create_parser()
     args = parser.parse_args()
 
-    if args.filter is None:
-        resample = Image.NEAREST
-    else:
-        filter_arg = args.filter.upper()
-        if filter_arg == "NEAREST":
-            resample = Image.NEAREST
-        elif filter_arg == "BOX":
-            resample = Image.BOX
-        elif filter_arg == "BILINEAR":
-            resample = Image.BILINEAR
-        elif filter_arg == "HAMMING":
-            resample = Image.HAMMING
-        elif filter_arg == "BICUBIC":
-            resample = Image.BICUBIC
-        elif filter_arg == "LANCZOS":
-            resample = Image.LANCZOS
-        else:
-            resample = Image.NEAREST
+    resample = get_filter(args.filter)
     
     dest_dir = "." if args.dest_dir is None else args.dest_dir
-    try:
-        os.makedirs(dest_dir, exist_ok=True)
-    except FileExistsError as e:
-        print("ERROR: dest_dir is " + e.filename)
-        sys.exit(1)
+
+    sizes = []
+    for arg_size in args.size:
+        if not check_size(arg_size, args.thumbnail):
+            print("ERROR: Invalid size option: " + arg_size)
+            sys.exit(1)
+        sizes.append(compile_size(arg_size, args.thumbnail))
+
+    labels = {}
+    for arg_size in args.size:
+        label = rendition_label(arg_size)
+        if len(args.size) > 1 and label in labels:
+            print("ERROR: Sizes %s and %s write to the same output: %s" % (labels[label], arg_size, label))
+            sys.exit(1)
+        labels[label] = arg_size
 
     if os.path.isfile(args.source):
-        resize(args.source, args.size, dest_dir, resample, args.thumbnail, args.verbose)
-    
+        files = [args.source]
     elif os.path.isdir(args.source):
-        files = glob.glob(args.source + "/*")
-        for f in files:
-            resize(f, args.size, dest_dir, resample, args.thumbnail, args.verbose)
-
+        files = sorted(glob.glob(args.source + "/*"))
     else:
         print("ERROR: Source file or dir does not exist.")
         sys.exit(1)
 
+    if args.plan is not None:
+        rows = plan_report(files, sizes, dest_dir, args.suffix)
+        print_plan(rows, args.plan)
+        if any(row["action"] == "error" for row in rows):
+            sys.exit(1)
+        return
+
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        if len(sizes) > 1 and not args.suffix:
+            for plan in sizes:
+                os.makedirs(rendition_path(dest_dir, "", plan, False)[0], exist_ok=True)
+    except FileExistsError as e:
+        print("ERROR: dest_dir is " + e.filename)
+        sys.exit(1)
+
+    failed = resize_all(files, sizes, dest_dir, resample, args.thumbnail, args.verbose, args.jobs, args.reducing_gap, args.suffix)
+    if failed:
+        print("ERROR: %d of %d files failed." % (len(failed), len(files)))
+        for f, e in failed:
+            print("  %s: %s" % (f, e))
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
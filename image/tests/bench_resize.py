@@ -0,0 +1,51 @@
+import io
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from resize import resize_image
+
+
+def photo(w, h):
+    ######### Smooth gradients plus fine noise, so both speed and detail loss show up.
+    y, x = np.mgrid[0:h, 0:w]
+    base = np.stack([x * 255 // w, y * 255 // h, (x + y) * 255 // (w + h)], axis=2)
+    noise = np.random.default_rng(0).integers(-20, 21, (h, w, 3))
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8)).save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+def bench(data, size_opt, reducing_gap):
+    start = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as img:
+        result, size = resize_image(img, size_opt, Image.LANCZOS, False, reducing_gap)
+        result.load()
+    return time.perf_counter() - start, result
+
+def psnr(a, b):
+    mse = np.mean((np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def main():
+    # ex.) python bench_resize.py 6000x4000 300
+    source = sys.argv[1] if len(sys.argv) > 1 else "6000x4000"
+    size_opt = sys.argv[2] if len(sys.argv) > 2 else "300"
+    w, h = (int(s) for s in source.lower().split("x"))
+    data = photo(w, h)
+
+    full_time, full = bench(data, size_opt, None)
+    print("Source: %sx%s JPEG -> %s (%sx%s)" % (w, h, size_opt, full.width, full.height))
+    print("Full decode + LANCZOS: %.3f s" % full_time)
+    for gap in [2.0, 3.0]:
+        fast_time, fast = bench(data, size_opt, gap)
+        assert fast.size == full.size
+        print("Reducing gap %.1f     : %.3f s  (%.1fx, PSNR %.1f dB)" % (gap, fast_time, full_time / fast_time, psnr(full, fast)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from transparent import select_color, transparent
+
+
+def transparent_per_pixel(img, threshold):
+    w, h = img.size
+    transparent_img = Image.new('RGBA', (w, h))
+    np.array([[transparent_img.putpixel((x, y), select_color(img.getpixel((x,y)), threshold)) for x in range(w)] for y in range(h)])
+    return transparent_img
+
+def bench(func, img, threshold):
+    start = time.perf_counter()
+    result = func(img, threshold)
+    return time.perf_counter() - start, result
+
+
+def main():
+    # ex.) python bench_transparent.py 620x877  (A4 at 75 dpi)
+    size = sys.argv[1] if len(sys.argv) > 1 else "620x877"
+    w, h = (int(s) for s in size.lower().split("x"))
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(200, 256, (h, w, 3), dtype=np.uint8))
+
+    old_time, old_img = bench(transparent_per_pixel, img, "250")
+    new_time, new_img = bench(transparent, img, "250")
+    print("Size: %sx%s" % (w, h))
+    print("Per-pixel : %.3f s" % old_time)
+    print("Vectorized: %.3f s" % new_time)
+    print("Speedup   : %.0fx" % (old_time / new_time))
+    print("Identical :", old_img.tobytes() == new_img.tobytes())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import pytest
+import os
+import sys
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from hanko import hanko_file
+from resize import resize
+from transparent import trans
+
+
+@pytest.fixture(scope='session')
+def stamp_img() -> Image:
+    rng = np.random.default_rng(0)
+    a = np.full((480, 640, 3), 255, dtype=np.uint8)
+    a[100:380, 150:490] = rng.integers(0, 256, (280, 340, 3), dtype=np.uint8)
+    return Image.fromarray(a)
+
+@pytest.mark.parametrize(('size_opt', 'thumbnail'), [
+    ("300", False),
+    ("200x200", False),
+    ("50%x", False),
+    ("120x120", True),
+])
+def test_hanko_matches_two_step(stamp_img, tmp_path, size_opt, thumbnail):
+    src = tmp_path / "stamp.jpg"
+    stamp_img.save(src)
+    for d in ["transparent", "resize", "hanko"]:
+        (tmp_path / d).mkdir()
+
+    trans(str(src), str(tmp_path / "transparent"), False, "250")
+    resize(str(tmp_path / "transparent" / "stamp.png"), size_opt, str(tmp_path / "resize"), Image.LANCZOS, thumbnail, False)
+    output, error = hanko_file(str(src), str(tmp_path / "hanko"), "250", size_opt, Image.LANCZOS, thumbnail)
+
+    assert error is None
+    with Image.open(tmp_path / "resize" / "stamp.png") as expected, Image.open(output) as result:
+        assert result.size == expected.size
+        assert result.tobytes() == expected.tobytes()
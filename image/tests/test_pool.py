@@ -0,0 +1,26 @@
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from pool import map_files
+
+
+def square(n):
+    return n * n
+
+@pytest.mark.parametrize('jobs', [None, 0, 1, 2, 8])
+@pytest.mark.parametrize('count', [0, 1, 5, 300])
+def test_map_files_order(jobs, count):
+    files = list(range(count))
+    assert list(map_files(square, files, jobs)) == [n * n for n in files]
+
+def test_map_files_serial_is_lazy():
+    seen = []
+    def work(f):
+        seen.append(f)
+        return f
+    results = map_files(work, [1, 2, 3], 1)
+    assert next(results) == 1
+    assert seen == [1]
@@ -1,5 +1,6 @@
 import pytest
 import os
+import argparse
 import sys
 from PIL import Image
 from decimal import Decimal, getcontext, FloatOperation, ROUND_HALF_UP
@@ -14,6 +15,18 @@ from resize import (
     get_size,
     percent,
     round_halfup,
+    check_size,
+    resize_all,
+    resize_image,
+    renditions_file,
+    rendition_path,
+    rendition_label,
+    compile_size,
+    target_size,
+    plan_report,
+    reducing_gap_value,
+    renditions,
+    thumbnail_size,
 )
 
 
@@ -158,5 +171,160 @@ def test_percent(s, expected):
 def test_percent(num, expected):
     assert round_halfup(Decimal(num)) == expected 
 
+@pytest.mark.parametrize(('size_opt', 'thumbnail', 'expected'), [
+    ("300", False, True),
+    ("50%x", False, True),
+    ("350x240!", False, True),
+    ("200x200", True, True),
+    ("abc", False, False),
+    ("%x%", False, False),
+    ("x", False, False),
+    ("300x", True, False),
+])
+def test_check_size(size_opt, thumbnail, expected):
+    assert check_size(size_opt, thumbnail) == expected
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_resize_all(img3, tmp_path, capsys, jobs):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    img3.save(src / "a.png")
+    (src / "b.png").write_bytes(b"not an image")
+    img3.resize((100, 100)).save(src / "c.png")
+    files = sorted(str(p) for p in src.iterdir())
+
+    failed = resize_all(files, ["200x200>"], str(dst), Image.NEAREST, False, True, jobs)
+
+    assert [f for f, e in failed] == [str(src / "b.png")]
+    assert os.listdir(dst) == ["a.png"]
+    with Image.open(dst / "a.png") as result:
+        assert result.size == (200, 113)
+    assert capsys.readouterr().out.splitlines() == [
+        "Success <Resize> <200x113>: " + str(dst) + "/a.png",
+        "Error:  " + str(src / "b.png"),
+        "Non operation:  " + str(src / "c.png"),
+    ]
+
+@pytest.mark.parametrize('sizes', [["200x200>"], ["200x", "100x"]])
+def test_resize_all_counts_any_error(img3, tmp_path, monkeypatch, sizes):
+    # DecompressionBombError is not an OSError; it must still be a per-file failure.
+    img3.save(tmp_path / "a.png")
+    for label in ["200x", "100x"]:
+        (tmp_path / label).mkdir()
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    failed = resize_all([str(tmp_path / "a.png")], sizes, str(tmp_path), Image.NEAREST, False, False, 1)
+    assert [(f, type(e)) for f, e in failed] == [(str(tmp_path / "a.png"), Image.DecompressionBombError)]
+
+def test_renditions_thumbnail():
+    # Thumbnails made from an earlier, rounded rendition have the size of separate runs.
+    img = Image.new("RGB", (4000, 2999))
+    sizes = ["1600x1600", "700x700", "333x333", "150x150"]
+    results = renditions(img, sizes, Image.BILINEAR, True)
+    for arg_size, (img_resize, size) in zip(sizes, results):
+        single = img.copy()
+        single.thumbnail(size, Image.BILINEAR)
+        assert img_resize.size == single.size
+    assert results[3][0].size == (150, 112)
+
+@pytest.mark.parametrize('size', [(4000, 2999), (2999, 4000), (61, 43), (1000, 1), (1, 1000)])
+@pytest.mark.parametrize('box', [(150, 150), (333, 100), (7, 700), (5000, 5000)])
+def test_thumbnail_size(size, box):
+    img = Image.new("L", size)
+    img.thumbnail(box)
+    assert thumbnail_size(size, box) == img.size
+
+@pytest.mark.parametrize('fmt', ["JPEG", "PNG"])
+@pytest.mark.parametrize('size_opt', ["300", "x77", "10%x10%", "350x240!", "500x200", "2500x1500"])
+def test_resize_image_reducing_gap(img3, tmp_path, fmt, size_opt):
+    path = tmp_path / ("src." + fmt.lower())
+    img3.save(path, fmt)
+    with Image.open(path) as img:
+        expected = resize_image(img, size_opt, Image.LANCZOS, False)[0].size
+    with Image.open(path) as img:
+        result, size = resize_image(img, size_opt, Image.LANCZOS, False, 3.0)
+    assert result.size == expected
+    assert size == expected
+
+@pytest.mark.parametrize(('s', 'expected'), [
+    ("1", 1.0),
+    ("1.0", 1.0),
+    ("3", 3.0),
+    ("2.5", 2.5),
+])
+def test_reducing_gap_value(s, expected):
+    assert reducing_gap_value(s) == expected
+
+@pytest.mark.parametrize('s', ["0", "0.5", "-3", "abc", "", "nan", "inf"])
+def test_reducing_gap_value_rejects(s):
+    with pytest.raises(argparse.ArgumentTypeError):
+        reducing_gap_value(s)
+
+@pytest.mark.parametrize(('size_opt', 'expected'), [
+    ("800x", "800x"),
+    ("800x600!", "800x600!"),
+    ("800x600>", "800x600gt"),
+    ("800x600<", "800x600lt"),
+    ("800x600^", "800x600fill"),
+    ("50%X50%", "50%x50%"),
+    ("**200**x$$$300%***", "__200__x___300%___"),
+])
+def test_rendition_label(size_opt, expected):
+    assert rendition_label(size_opt) == expected
+    assert rendition_label(compile_size(size_opt, False)) == expected
+    assert rendition_path("out", "photo", size_opt, False) == ("out/" + expected, "photo")
+    assert rendition_path("out", "photo", size_opt, True) == ("out", "photo_" + expected)
+
+@pytest.mark.parametrize('suffix', [False, True])
+def test_renditions_file(img3, tmp_path, suffix):
+    src = tmp_path / "photo.png"
+    img3.save(src)
+    sizes = ["300x", "1600x", "800x", "100x100!", "4000x4000>"]
+    for label in ["300x", "1600x", "800x", "100x100!"]:
+        (tmp_path / label).mkdir()
+
+    outputs, error = renditions_file(str(src), sizes, str(tmp_path), Image.LANCZOS, False, suffix=suffix)
+
+    assert error is None
+    assert outputs[4] is None
+    for arg_size, (width, height, path) in zip(sizes[:4], outputs[:4]):
+        expected = "%s/photo_%s.png" % (tmp_path, arg_size) if suffix else "%s/%s/photo.png" % (tmp_path, arg_size)
+        assert path == expected
+        with Image.open(src) as img:
+            single = resize_image(img, arg_size, Image.LANCZOS, False)[0]
+        with Image.open(path) as result:
+            assert result.size == single.size == (width, height)
+
+@pytest.mark.parametrize('size_opt', ["300", "x77", "10%x10%", "350x240!", "500x200", "500x200>", "500x200<", "500x200^", "**200**x$$$300%***"])
+@pytest.mark.parametrize('thumbnail', [False, True])
+def test_compile_size(img3, size_opt, thumbnail):
+    def result(size):
+        try:
+            return target_size(img3, size, thumbnail)
+        except ValueError:
+            return "error"
+    assert result(compile_size(size_opt, thumbnail)) == result(size_opt)
+
+def test_plan_report(img3, tmp_path):
+    img3.save(tmp_path / "a.png")
+    (tmp_path / "b.png").write_bytes(b"not an image")
+    files = [str(tmp_path / "a.png"), str(tmp_path / "b.png")]
+    sizes = [compile_size("300x", False), compile_size("4000x4000>", False)]
+
+    rows = plan_report(files, sizes, "out")
 
+    assert [(r["file"], r["size"], r["target_width"], r["target_height"], r["action"], r["output"]) for r in rows] == [
+        (files[0], "300x", 300, 169, "resize", "out/300x/a.png"),
+        (files[0], "4000x4000>", None, None, "skip", None),
+        (files[1], None, None, None, "error", None),
+    ]
+    assert rows[0]["width"] == 1920 and rows[0]["height"] == 1080
 
+def test_plan_report_bomb(img3, tmp_path, monkeypatch):
+    # DecompressionBombError is not an OSError; it is an error row, not a crash.
+    img3.save(tmp_path / "a.png")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    rows = plan_report([str(tmp_path / "a.png")], [compile_size("300x", False)], "out")
+    assert [(r["file"], r["action"]) for r in rows] == [(str(tmp_path / "a.png"), "error")]
+    assert "decompression bomb" in rows[0]["error"]
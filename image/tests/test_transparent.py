@@ -0,0 +1,271 @@
+import pytest
+import os
+import sys
+import struct
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from transparent import (
+    select_color,
+    transparent,
+    trans_all,
+    transparent_bands,
+    image_bands,
+    png_layout,
+    png_bands,
+    save_png_bands,
+    write_chunk,
+    trans_file,
+    threshold_value,
+    pad_value,
+)
+import argparse
+
+
+def transparent_per_pixel(img, threshold):
+    w, h = img.size
+    transparent_img = Image.new('RGBA', (w, h))
+    for y in range(h):
+        for x in range(w):
+            transparent_img.putpixel((x, y), select_color(img.getpixel((x, y)), threshold))
+    return transparent_img
+
+
+@pytest.fixture(scope='session')
+def noise_img() -> Image:
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (37, 53, 3), dtype=np.uint8))
+
+@pytest.fixture(scope='session')
+def edge_img() -> Image:
+    # Sums right around 3 * 250 to catch rounding of the mean.
+    colors = [(250, 250, 250), (250, 250, 249), (251, 250, 249), (255, 255, 244), (249, 249, 251), (0, 0, 0), (255, 255, 255)]
+    return Image.fromarray(np.array([colors], dtype=np.uint8))
+
+@pytest.mark.parametrize('threshold', ["0", "1", "128", "250", "255", "256"])
+def test_transparent_noise(noise_img, threshold):
+    assert transparent(noise_img, threshold).tobytes() == transparent_per_pixel(noise_img, threshold).tobytes()
+
+@pytest.mark.parametrize('threshold', ["249", "250", "251"])
+def test_transparent_edge(edge_img, threshold):
+    assert transparent(edge_img, threshold).tobytes() == transparent_per_pixel(edge_img, threshold).tobytes()
+
+def test_transparent_mode(noise_img):
+    result = transparent(noise_img, "250")
+    assert result.mode == "RGBA"
+    assert result.size == noise_img.size
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_trans_all(noise_img, tmp_path, capsys, jobs):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    for name in ["a", "b", "d"]:
+        noise_img.save(src / (name + ".png"))
+    (src / "c.png").write_bytes(b"not an image")
+    files = sorted(str(p) for p in src.iterdir())
+
+    failed = trans_all(files, str(dst), True, "128", jobs)
+
+    assert failed == [str(src / "c.png")]
+    assert sorted(os.listdir(dst)) == ["a.png", "b.png", "d.png"]
+    assert capsys.readouterr().out.splitlines() == [
+        "Success Transparent: " + str(dst) + "/a.png",
+        "Success Transparent: " + str(dst) + "/b.png",
+        "Error: " + str(src / "c.png"),
+        "Success Transparent: " + str(dst) + "/d.png",
+    ]
+
+@pytest.mark.parametrize('band', [1, 5, 37, 100])
+def test_save_png_bands(noise_img, tmp_path, band):
+    path = tmp_path / "band.png"
+    save_png_bands(str(path), noise_img.size, transparent_bands(image_bands(noise_img, band), "128"))
+    full = tmp_path / "full.png"
+    transparent(noise_img, "128").save(full)
+    assert path.read_bytes() == full.read_bytes()
+
+@pytest.mark.parametrize('band', [1, 7, 100])
+@pytest.mark.parametrize('soft', [None, (200, 250)])
+@pytest.mark.parametrize('autocrop', [None, 0, 3])
+def test_trans_file_bands_match_full(stamp_img, tmp_path, band, soft, autocrop):
+    src = tmp_path / "stamp.png"
+    stamp_img.save(src)
+    (tmp_path / "band").mkdir()
+    (tmp_path / "full").mkdir()
+    banded, error = trans_file(str(src), str(tmp_path / "band"), "250", band, soft, autocrop)
+    assert error is None
+    full, error = trans_file(str(src), str(tmp_path / "full"), "250", 0, soft, autocrop)
+    assert error is None
+    with open(banded, "rb") as a, open(full, "rb") as b:
+        assert a.read() == b.read()
+
+@pytest.mark.parametrize(('soft', 'color', 'expected'), [
+    ((200, 250), (0, 0, 0), (0, 0, 0, 255)),
+    ((200, 250), (200, 200, 200), (200, 200, 200, 255)),
+    ((200, 250), (225, 225, 225), (225, 225, 225, 128)),
+    ((200, 250), (249, 249, 249), (249, 249, 249, 5)),
+    ((200, 250), (250, 250, 250), (255, 255, 255, 0)),
+    ((200, 250), (255, 255, 255), (255, 255, 255, 0)),
+    ((249, 250), (249, 249, 250), (249, 249, 250, 255)),
+    ((249, 250), (250, 250, 249), (250, 250, 249, 255)),
+])
+def test_transparent_soft(soft, color, expected):
+    img = Image.new("RGB", (1, 1), color)
+    assert transparent(img, "250", soft).getpixel((0, 0)) == expected
+
+def test_transparent_soft_step(noise_img):
+    # LOW:HIGH one apart is the hard threshold at HIGH.
+    assert transparent(noise_img, "128", (127, 128)).tobytes() == transparent(noise_img, "128").tobytes()
+
+@pytest.fixture(scope='session')
+def stamp_img() -> Image:
+    a = np.full((60, 80, 3), 255, dtype=np.uint8)
+    a[10:20, 30:45] = (200, 0, 0)
+    return Image.fromarray(a)
+
+@pytest.mark.parametrize(('pad', 'expected'), [
+    (None, (80, 60)),
+    (0, (15, 10)),
+    (5, (25, 20)),
+    (35, (80, 55)),
+])
+def test_transparent_autocrop(stamp_img, pad, expected):
+    result = transparent(stamp_img, "250", autocrop=pad)
+    assert result.size == expected
+    assert np.count_nonzero(np.asarray(result)[..., 3]) == 15 * 10
+
+def test_transparent_autocrop_empty():
+    img = Image.new("RGB", (8, 4), (255, 255, 255))
+    assert transparent(img, "250", autocrop=0).size == (8, 4)
+
+@pytest.mark.parametrize('band', [0, 7, 100])
+def test_trans_file_autocrop(stamp_img, tmp_path, band):
+    src = tmp_path / "stamp.png"
+    stamp_img.save(src)
+    output, error = trans_file(str(src), str(tmp_path), "250", band, autocrop=2)
+    assert error is None
+    with Image.open(output) as result:
+        assert result.tobytes() == transparent(stamp_img, "250", autocrop=2).tobytes()
+
+def test_trans_file_bands_large(stamp_img, tmp_path, monkeypatch):
+    # PNGs are read band by band, so the bomb check only sees the band.
+    src = tmp_path / "stamp.png"
+    stamp_img.save(src)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    output, error = trans_file(str(src), str(tmp_path), "250", 4)
+    assert error is None
+    monkeypatch.undo()
+    with Image.open(output) as result:
+        assert result.tobytes() == transparent(stamp_img, "250").tobytes()
+
+def test_trans_file_bands_large_other_format(stamp_img, tmp_path, monkeypatch):
+    # Other formats are decoded whole, so PIL's bomb check still applies.
+    src = tmp_path / "stamp.bmp"
+    stamp_img.save(src)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    output, error = trans_file(str(src), str(tmp_path), "250", 4)
+    assert isinstance(error, Image.DecompressionBombError)
+
+def png_variants(img):
+    rgba = img.convert("RGBA")
+    rgba.putpixel((0, 0), (10, 20, 30, 0))
+    yield "1", img.convert("1"), {}
+    yield "L", img.convert("L"), {}
+    yield "LA", rgba.convert("LA"), {}
+    yield "RGB", img, {}
+    yield "RGBA", rgba, {}
+    yield "P", img.convert("P"), {"transparency": 3}
+    yield "P4", img.convert("L").point(lambda v: v // 16).convert("P"), {"bits": 4}
+    yield "I;16", Image.fromarray(np.asarray(img.convert("L")).astype(np.uint16) * 257), {}
+
+@pytest.mark.parametrize('band', [1, 6, 100])
+def test_png_bands(noise_img, tmp_path, band):
+    for name, img, params in png_variants(noise_img):
+        path = tmp_path / (name + ".png")
+        img.save(path, **params)
+        layout = png_layout(str(path))
+        assert layout is not None, name
+        with Image.open(path) as full:
+            expected = np.asarray(full.convert("RGB"))
+        bands = list(png_bands(str(path), layout, band))
+        assert [len(b) for b in bands] == [min(band, 37 - top) for top in range(0, 37, band)], name
+        assert np.array_equal(np.concatenate(bands), expected), name
+
+@pytest.mark.parametrize(('depth', 'color_type', 'interlace', 'supported'), [
+    (8, 2, 0, True),
+    (8, 2, 1, False),
+    (16, 0, 0, True),
+    (16, 2, 0, False),
+    (16, 6, 0, False),
+    (8, 5, 0, False),
+])
+def test_png_layout(tmp_path, depth, color_type, interlace, supported):
+    path = tmp_path / "head.png"
+    with open(path, "wb") as fp:
+        fp.write(b"\x89PNG\r\n\x1a\n")
+        write_chunk(fp, b"IHDR", struct.pack(">IIBBBBB", 5, 3, depth, color_type, 0, 0, interlace))
+        write_chunk(fp, b"IDAT", b"")
+    assert (png_layout(str(path)) is not None) == supported
+
+def test_png_layout_other_format(noise_img, tmp_path):
+    noise_img.save(tmp_path / "noise.bmp")
+    assert png_layout(str(tmp_path / "noise.bmp")) is None
+
+def test_png_bands_truncated(noise_img, tmp_path):
+    noise_img.save(tmp_path / "full.png")
+    data = (tmp_path / "full.png").read_bytes()
+    (tmp_path / "cut.png").write_bytes(data[:len(data) // 2])
+    layout = png_layout(str(tmp_path / "cut.png"))
+    with pytest.raises(OSError):
+        list(png_bands(str(tmp_path / "cut.png"), layout, 5))
+
+@pytest.mark.parametrize('value', ["abc", "-1", "257", "2.5"])
+def test_threshold_value_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        threshold_value(value)
+
+@pytest.mark.parametrize(('value', 'expected'), [("0", 0), ("8", 8)])
+def test_pad_value(value, expected):
+    assert pad_value(value) == expected
+
+@pytest.mark.parametrize('value', ["abc", "-1", "2.5"])
+def test_pad_value_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        pad_value(value)
+
+def test_trans_all_counts_any_error(noise_img, tmp_path, monkeypatch):
+    # DecompressionBombError is not an OSError; it must still be a per-file failure.
+    src = tmp_path / "src"
+    src.mkdir()
+    noise_img.save(src / "a.png")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    failed = trans_all([str(src / "a.png")], str(tmp_path), False, 250, 1)
+    assert failed == [str(src / "a.png")]
+
+@pytest.mark.parametrize('band', [0, 16])
+def test_trans_file_in_place(tmp_path, band):
+    # Large enough that the source is not read in one buffer before the output is opened.
+    img = Image.fromarray(np.random.default_rng(1).integers(0, 256, (300, 300, 3), dtype=np.uint8))
+    src = tmp_path / "noise.png"
+    img.save(src)
+    output, error = trans_file(str(src), str(tmp_path), "128", band)
+    assert error is None
+    assert os.listdir(tmp_path) == ["noise.png"]
+    with Image.open(output) as result:
+        assert result.tobytes() == transparent(img, "128").tobytes()
+
+def test_trans_file_bands_failure_keeps_output(noise_img, tmp_path):
+    noise_img.save(tmp_path / "full.png")
+    data = (tmp_path / "full.png").read_bytes()
+    src = tmp_path / "broken.png"
+    src.write_bytes(data[:len(data) // 2])
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    (dst / "broken.png").write_bytes(b"old")
+    output, error = trans_file(str(src), str(dst), "250", 16)
+    assert error is not None
+    assert os.listdir(dst) == ["broken.png"]
+    assert (dst / "broken.png").read_bytes() == b"old"
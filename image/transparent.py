@@ -1,9 +1,14 @@
+import io
 import os
 import sys
 import argparse
 import glob
+import struct
+import zlib
+from functools import partial
 from PIL import Image, ImageDraw
 import numpy as np
+from pool import map_files
 
 
 def create_parser():
@@ -22,10 +27,38 @@ def create_parser():
     )
     parser.add_argument(
         "-t", "--threshold",
-        type=str,
-        default="250",
+        type=threshold_value,
+        default=250,
         help="The brightness of the pixel is the threshold. Brightness is the average of rgb. Default is 250."
     )
+    parser.add_argument(
+        "-s", "--soft",
+        type=soft_range,
+        default=None,
+        metavar="LOW:HIGH",
+        help="Soft edges instead of the threshold. Brightness up to LOW stays opaque, from HIGH is fully transparent, and alpha falls linearly in between. ex.) 200:250"
+    )
+    parser.add_argument(
+        "-a", "--autocrop",
+        type=pad_value,
+        nargs="?",
+        const=0,
+        default=None,
+        metavar="PAD",
+        help="Crop the output to the non-transparent area, leaving PAD pixels of margin. Default PAD is 0."
+    )
+    parser.add_argument(
+        "-b", "--band",
+        type=int,
+        default=0,
+        help="Process the image in bands of this many rows. Non-interlaced PNGs are also read band by band, so memory does not grow with the image size; other formats are decoded whole and only the working memory is reduced. Default is 0 (whole image at once)."
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used when source is a directory. Default is the number of CPUs."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -33,26 +66,315 @@ def create_parser():
     )
     return parser
 
+def threshold_value(s):
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("integer expected, got " + repr(s))
+    if not 0 <= value <= 256:
+        raise argparse.ArgumentTypeError("0 <= THRESHOLD <= 256 expected, got " + repr(s))
+    return value
+
+def pad_value(s):
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("integer expected, got " + repr(s))
+    if value < 0:
+        raise argparse.ArgumentTypeError("PAD >= 0 expected, got " + repr(s))
+    return value
+
+def soft_range(s):
+    try:
+        low, high = (int(v) for v in s.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("LOW:HIGH expected, got " + repr(s))
+    if not 0 <= low < high <= 256:
+        raise argparse.ArgumentTypeError("0 <= LOW < HIGH <= 256 expected, got " + repr(s))
+    return low, high
+
 def select_color(color, threshold):
     mean = np.array(color).mean(axis=0)
     return (255,255,255,0) if mean >= int(threshold) else color
 
-def transparent(img, threshold):
+def soft_alpha(low, high):
+    ######### Alpha for each integer mean brightness 0-255.
+    mean = np.arange(256)
+    return np.clip(np.round(255 * (high - mean) / (high - low)), 0, 255).astype(np.uint8)
+
+def transparent(img, threshold, soft=None, autocrop=None):
+    rgb = np.asarray(img if img.mode == "RGB" else img.convert("RGB"))
+    rgba = transparent_array(rgb, threshold, soft)
+    if autocrop is not None:
+        box = alpha_bbox(rgba[..., 3])
+        if box is not None:
+            left, top, right, bottom = pad_box(box, autocrop, img.size)
+            rgba = rgba[top:bottom, left:right]
+    return Image.fromarray(rgba)
+
+def transparent_array(rgb, threshold, soft=None):
+    rgba = np.empty(rgb.shape[:2] + (4,), dtype=np.uint8)
+    rgba[..., :3] = rgb
+    rgba[..., 3] = alpha_array(rgb, threshold, soft)
+    rgba[rgba[..., 3] == 0] = (255, 255, 255, 0)
+    return rgba
+
+def alpha_array(rgb, threshold, soft=None):
+    total = rgb.sum(axis=2, dtype=np.uint16)
+    if soft is None:
+        # mean >= threshold, compared as integer sum to avoid a float64 copy of the image
+        return np.where(total >= 3 * int(threshold), np.uint8(0), np.uint8(255))
+    return soft_alpha(*soft)[total // 3]
+
+def alpha_bbox(alpha, top=0):
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(alpha.any(axis=0))
+    return int(cols[0]), top + int(rows[0]), int(cols[-1]) + 1, top + int(rows[-1]) + 1
+
+def pad_box(box, pad, size):
+    left, top, right, bottom = box
+    w, h = size
+    return max(left - pad, 0), max(top - pad, 0), min(right + pad, w), min(bottom + pad, h)
+
+PNG_FILTERS = (0, 2, 1, 4)
+FILTER_COST = np.minimum(np.arange(256), 256 - np.arange(256)).astype(np.uint8)
+
+def transparent_bands(bands, threshold, soft=None, box=None):
+    ######### bands are RGB arrays of consecutive rows; box crops them on the way through.
+    top = 0
+    for rgb in bands:
+        rows = rgb
+        if box is not None:
+            left, box_top, right, bottom = box
+            rows = rgb[max(box_top - top, 0):max(bottom - top, 0), left:right]
+        top += len(rgb)
+        if len(rows):
+            yield transparent_array(rows, threshold, soft)
+
+def alpha_bbox_bands(bands, threshold, soft=None):
+    boxes = []
+    top = 0
+    for rgb in bands:
+        box = alpha_bbox(alpha_array(rgb, threshold, soft), top)
+        if box is not None:
+            boxes.append(box)
+        top += len(rgb)
+    if not boxes:
+        return None
+    lefts, tops, rights, bottoms = zip(*boxes)
+    return min(lefts), min(tops), max(rights), max(bottoms)
+
+def image_bands(img, band):
+    ######### Cropping decodes the whole image on the first band; only the working copies are banded.
     w, h = img.size
-    transparent_img = Image.new('RGBA', (w, h))
-    np.array([[transparent_img.putpixel((x, y), select_color(img.getpixel((x,y)), threshold)) for x in range(w)] for y in range(h)])
-    return transparent_img
+    for top in range(0, h, band):
+        yield np.asarray(img.crop((0, top, w, min(top + band, h))).convert("RGB"))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+######### 8-bit color type for each number of bytes per pixel, used to unfilter raw rows.
+PNG_RAW_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+def png_layout(f):
+    ######### Header of a PNG that png_bands can read, or None for anything else.
+    with open(f, "rb") as fp:
+        if fp.read(8) != PNG_SIGNATURE:
+            return None
+        ihdr = None
+        chunks = b""
+        while True:
+            head = fp.read(8)
+            if len(head) < 8:
+                return None
+            length, chunk_type = struct.unpack(">I4s", head)
+            if chunk_type == b"IDAT":
+                break
+            data = fp.read(length)
+            fp.seek(4, os.SEEK_CUR)
+            if chunk_type == b"IHDR":
+                ihdr = data
+            elif chunk_type in (b"PLTE", b"tRNS"):
+                chunks += head + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+        if ihdr is None or len(ihdr) != 13:
+            return None
+        w, h, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", ihdr)
+        if interlace or color_type not in PNG_CHANNELS:
+            return None
+        bits = PNG_CHANNELS[color_type] * depth
+        bpp = max(1, bits // 8)
+        if bpp not in PNG_RAW_TYPES:
+            return None
+        return {
+            "size": (w, h), "depth": depth, "color_type": color_type, "chunks": chunks,
+            "rowbytes": (w * bits + 7) // 8, "bpp": bpp, "idat": fp.tell() - 8,
+        }
+
+def png_bands(f, layout, band):
+    ######### Decode a non-interlaced PNG a band of rows at a time, so memory follows the band and
+    ######### not the image. The zlib stream is inflated only as far as the band needs; each band
+    ######### is then unfiltered by PIL as a small PNG whose first row is the previous raw row.
+    w, h = layout["size"]
+    rowbytes, bpp = layout["rowbytes"], layout["bpp"]
+    prior = bytes(rowbytes)
+    with open(f, "rb") as fp:
+        fp.seek(layout["idat"])
+        inflater = zlib.decompressobj()
+        pending = bytearray()
+        for top in range(0, h, band):
+            rows = min(band, h - top)
+            need = rows * (rowbytes + 1)
+            while len(pending) < need:
+                data = inflater.unconsumed_tail or read_idat(fp)
+                pending += inflater.decompress(data, need - len(pending))
+            filtered = bytes(pending[:need])
+            del pending[:need]
+
+            raw_type = PNG_RAW_TYPES[bpp]
+            header = struct.pack(">IIBBBBB", rowbytes // bpp, rows + 1, 8, raw_type, 0, 0, 0)
+            with png_image(header, b"", b"\x00" + prior + filtered) as img:
+                raw = np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(rows + 1, rowbytes)[1:]
+            prior = raw[-1].tobytes()
+
+            unfiltered = np.zeros((rows, rowbytes + 1), dtype=np.uint8)
+            unfiltered[:, 1:] = raw
+            header = struct.pack(">IIBBBBB", w, rows, layout["depth"], layout["color_type"], 0, 0, 0)
+            with png_image(header, layout["chunks"], unfiltered.tobytes()) as img:
+                yield np.asarray(img.convert("RGB"))
+
+def read_idat(fp):
+    head = fp.read(8)
+    if len(head) < 8:
+        raise OSError("image file is truncated")
+    length, chunk_type = struct.unpack(">I4s", head)
+    if chunk_type != b"IDAT":
+        raise OSError("image file is truncated")
+    data = fp.read(length)
+    fp.seek(4, os.SEEK_CUR)
+    if len(data) < length:
+        raise OSError("image file is truncated")
+    return data
+
+def png_image(ihdr, chunks, scanlines):
+    fp = io.BytesIO()
+    fp.write(PNG_SIGNATURE)
+    write_chunk(fp, b"IHDR", ihdr)
+    fp.write(chunks)
+    ######### Stored (level 0) deflate: the rows are only wrapped, not compressed again.
+    write_chunk(fp, b"IDAT", zlib.compress(scanlines, 0))
+    write_chunk(fp, b"IEND", b"")
+    fp.seek(0)
+    img = Image.open(fp)
+    img.load()
+    return img
 
-def trans(f, dst_dir, verbose, threshold):
+def save_png_bands(path, size, bands):
+    ######### 8-bit RGBA PNG, written band by band. Filters, deflate settings and IDAT chunk
+    ######### size are PIL's, so the file is the same as a full-image save.
+    ######### The bands may still be read from path itself, so write beside it and replace at the end.
+    tmp = path + ".tmp"
+    try:
+        write_png_bands(tmp, size, bands)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def write_png_bands(path, size, bands):
+    w, h = size
+    idat_size = max(65536, w * 4)
+    with open(path, "wb") as fp:
+        fp.write(b"\x89PNG\r\n\x1a\n")
+        write_chunk(fp, b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0))
+        ######### Same deflate settings as PIL's PNG encoder: memLevel 9 and Z_FILTERED.
+        compressor = zlib.compressobj(-1, zlib.DEFLATED, 15, 9, zlib.Z_FILTERED)
+        prior = np.zeros(w * 4, dtype=np.uint8)
+        pending = b""
+        for rgba in bands:
+            rows = rgba.reshape(rgba.shape[0], w * 4)
+            pending += compressor.compress(filter_rows(rows, prior))
+            prior = rows[-1].copy()
+            while len(pending) >= idat_size:
+                write_chunk(fp, b"IDAT", pending[:idat_size])
+                pending = pending[idat_size:]
+        pending += compressor.flush()
+        for start in range(0, len(pending), idat_size):
+            write_chunk(fp, b"IDAT", pending[start:start + idat_size])
+        write_chunk(fp, b"IEND", b"")
+
+def write_chunk(fp, chunk_type, data):
+    fp.write(struct.pack(">I", len(data)) + chunk_type + data)
+    fp.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+def filter_rows(rows, prior):
+    up = np.vstack([prior[np.newaxis], rows[:-1]])
+    left = np.zeros_like(rows)
+    left[:, 4:] = rows[:, :-4]
+    upleft = np.zeros_like(up)
+    upleft[:, 4:] = up[:, :-4]
+
+    a, b, c = left.astype(np.int16), up.astype(np.int16), upleft.astype(np.int16)
+    pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+    del a, b, c, pa, pb, pc
+
+    ######### Same choice as PIL's PNG encoder: None, Up, Sub, Paeth; the first smallest
+    ######### sum of absolute signed bytes wins. uint8 arithmetic wraps like the PNG filters.
+    candidates = [rows, rows - up, rows - left, rows - paeth]
+    cost = np.stack([FILTER_COST[c].sum(axis=1, dtype=np.int64) for c in candidates])
+    best = cost.argmin(axis=0)
+
+    out = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = np.array(PNG_FILTERS, dtype=np.uint8)[best]
+    for i, candidate in enumerate(candidates):
+        out[best == i, 1:] = candidate[best == i]
+    return out.tobytes()
+
+def trans_file(f, dst_dir, threshold, band=0, soft=None, autocrop=None):
     try:
-        original_img = Image.open(f).convert("RGB")
         root, ext = os.path.splitext(f)
         file_name = os.path.basename(root)
-        transparent(original_img, threshold).save(os.path.join(dst_dir, file_name + ".png"))
-        if verbose: print("Success Transparent: " + dst_dir + "/" + file_name + ".png")
-    except OSError as e:
-        print("Error: " + f.title)
-        pass
+        output = os.path.join(dst_dir, file_name + ".png")
+        if band > 0:
+            layout = png_layout(f)
+            if layout is None:
+                original_img = Image.open(f)
+                size = original_img.size
+                bands = partial(image_bands, original_img, band)
+            else:
+                size = layout["size"]
+                bands = partial(png_bands, f, layout, band)
+            box = None
+            if autocrop is not None:
+                box = alpha_bbox_bands(bands(), threshold, soft)
+                box = None if box is None else pad_box(box, autocrop, size)
+            if box is not None:
+                size = (box[2] - box[0], box[3] - box[1])
+            save_png_bands(output, size, transparent_bands(bands(), threshold, soft, box))
+        else:
+            original_img = Image.open(f)
+            transparent(original_img.convert("RGB"), threshold, soft, autocrop).save(output)
+        return dst_dir + "/" + file_name + ".png", None
+    except Exception as e:
+        return None, e
+
+def report(f, result, verbose, label="Transparent"):
+    output, error = result
+    if error is not None:
+        print("Error: " + f)
+        return False
+    if verbose: print("Success " + label + ": " + output)
+    return True
+
+def trans(f, dst_dir, verbose, threshold, band=0, soft=None, autocrop=None):
+    return report(f, trans_file(f, dst_dir, threshold, band, soft, autocrop), verbose)
+
+def trans_all(files, dst_dir, verbose, threshold, jobs, band=0, soft=None, autocrop=None):
+    work = partial(trans_file, dst_dir=dst_dir, threshold=threshold, band=band, soft=soft, autocrop=autocrop)
+    results = map_files(work, files, jobs)
+    return [f for f, result in zip(files, results) if not report(f, result, verbose)]
 
 
 def main():
@@ -67,12 +389,15 @@ def main():
         sys.exit(1)
 
     if os.path.isfile(args.source):
-        trans(args.source, dest_dir, args.verbose, args.threshold)
+        if not trans(args.source, dest_dir, args.verbose, args.threshold, args.band, args.soft, args.autocrop):
+            sys.exit(1)
     
     elif os.path.isdir(args.source):
-        files = glob.glob(args.source + "/*")
-        for f in files:
-            trans(f, dest_dir, args.verbose, args.threshold)
+        files = sorted(glob.glob(args.source + "/*"))
+        failed = trans_all(files, dest_dir, args.verbose, args.threshold, args.jobs, args.band, args.soft, args.autocrop)
+        if failed:
+            print("ERROR: %d of %d files failed." % (len(failed), len(files)))
+            sys.exit(1)
 
     else:
         print("ERROR: Source file or dir does not exist.")
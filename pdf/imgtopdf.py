@@ -1,14 +1,26 @@
 import sys
 import os
 import glob
-import tempfile
-import shutil
+import io
+import re
+import mmap
+import json
+import struct
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from decimal import Decimal
 import img2pdf
+import pikepdf
 from natsort import natsorted
+from PIL import Image
 import cv2
 
 
+######### img2pdf uses this when an image has no resolution of its own.
+DEFAULT_DPI = 96
+
+
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -28,6 +40,31 @@ def create_parser():
         action="store_true",
         help="Output file is a separate file. Pdf filename follows image file."
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used with --split when source is a directory. Default is the number of CPUs."
+    )
+    parser.add_argument(
+        "--append",
+        type=str,
+        default=None,
+        metavar="PDF",
+        help="Add the images that are not in PDF yet as new pages at its end. PDF.manifest.json lists the images already added; an existing PDF without it is refused. Destination is not used."
+    )
+    parser.add_argument(
+        "--max-dpi",
+        type=int,
+        default=None,
+        help="Downsample images above this resolution on the page and re-encode them once. Other images are embedded as they are."
+    )
+    parser.add_argument(
+        "--jpeg-quality",
+        type=int,
+        default=85,
+        help="JPEG quality of images downsampled by --max-dpi. 1-bit, palette and gray+alpha images are still kept lossless. Default is 85."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -35,13 +72,11 @@ def create_parser():
     )
     return parser
 
-def convert_pdf(input, output, source, destination, split, verbose):
+def convert_pdf(input, output, source, destination, split, verbose, jobs=1, **options):
     input_list = glob.glob(input + "/*")
 
     if split:
-        for file in natsorted(input_list):
-            origin_source = os.path.join(source, os.path.basename(file))
-            single_convert_pdf(file, output, origin_source, destination, verbose)
+        return split_all(natsorted(input_list), destination, verbose, jobs, **options)
 
     else:
         if verbose: print(source + "*", end=" > ")
@@ -49,16 +84,100 @@ def convert_pdf(input, output, source, destination, split, verbose):
             output = os.path.join(destination, "new.pdf")
 
         try:
-            with open(output, "wb") as f:
-                f.write(img2pdf.convert([str(i) for i in natsorted(input_list)]))
+            stats = write_pdf([str(i) for i in natsorted(input_list)], output, **options)
         except Exception as e:
             error_type = type(e).__name__
-            sys.stderr.write("{0}: {1}\n".format(error_type, e.message))
+            sys.stderr.write("{0}: {1}\n".format(error_type, e))
             sys.exit(1)
         
         if verbose: print(output)
+        if options.get("max_dpi"): print_savings(stats)
+        return []
+
+def split_file(input, destination, **options):
+    try:
+        root, ext = os.path.splitext(input)
+        output = os.path.join(destination, os.path.basename(root) + ".pdf")
+        return output, write_pdf([input], output, **options), None
+    except Exception as e:
+        return None, None, e
+
+def report(input, result, verbose):
+    output, stats, error = result
+    if error is not None:
+        sys.stderr.write("{0}: {1}: {2}\n".format(input, type(error).__name__, error))
+        return False
+    if verbose: print(input + " > " + output)
+    return True
+
+def split_all(files, destination, verbose, jobs, **options):
+    work = partial(split_file, destination=destination, **options)
+    if jobs is None or jobs <= 1 or len(files) <= 1:
+        results = [work(f) for f in files]
+        failed = [f for f, result in zip(files, results) if not report(f, result, verbose)]
+    else:
+        chunksize = max(1, min(64, len(files) // (jobs * 4)))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(work, files, chunksize=chunksize))
+            failed = [f for f, result in zip(files, results) if not report(f, result, verbose)]
+
+    if options.get("max_dpi"):
+        print_savings([sum(n) for n in zip(*[stats for output, stats, error in results if error is None])] or [0, 0, 0, 0])
+    return failed
+
+def print_savings(stats):
+    images, count, before, after = stats
+    print("Downsampled %d of %d images: %d > %d bytes, saved %d bytes." % (count, images, before, after, before - after))
 
-def single_convert_pdf(input, output, source, destination, verbose):
+def append_convert_pdf(source, output, verbose, **options):
+    manifest = output + ".manifest.json"
+    if os.path.isfile(source):
+        images = [source]
+    else:
+        skip = {os.path.abspath(output), os.path.abspath(manifest)}
+        images = [i for i in natsorted(glob.glob(source + "/*")) if os.path.abspath(i) not in skip]
+
+    ######### Without a manifest there is no telling which images an existing pdf holds.
+    if os.path.exists(output) and not os.path.exists(manifest):
+        print("ERROR: " + output + " exists without " + os.path.basename(manifest) + ".")
+        sys.exit(1)
+
+    ######### Without output the manifest is stale, so every image is new.
+    included = read_manifest(manifest) if os.path.exists(output) else []
+    names = set(included)
+    new_images = [i for i in images if os.path.basename(i) not in names]
+
+    if verbose: print(source, end=" >> ")
+    if not new_images:
+        if verbose: print(output + " (no new images)")
+        return
+
+    try:
+        if os.path.exists(output):
+            stats = append_pdf(new_images, output, **options)
+        else:
+            stats = write_pdf(new_images, output, **options)
+        write_manifest(manifest, included + [os.path.basename(i) for i in new_images])
+    except Exception as e:
+        error_type = type(e).__name__
+        sys.stderr.write("{0}: {1}\n".format(error_type, e))
+        sys.exit(1)
+
+    if verbose: print(output + " (%d new images)" % len(new_images))
+    if options.get("max_dpi"): print_savings(stats)
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(path, names):
+    with open(path + ".tmp", "w") as f:
+        json.dump(names, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def single_convert_pdf(input, output, source, destination, verbose, **options):
     if verbose: print(source, end=" > ")
     if output == "":
         root, ext = os.path.splitext(input)
@@ -66,25 +185,346 @@ def single_convert_pdf(input, output, source, destination, verbose):
         output = os.path.join(destination, file_name + ".pdf")
     
     try:
-        with open(output, "wb") as f:
-            f.write(img2pdf.convert([input]))
+        stats = write_pdf([input], output, **options)
     except Exception as e:
         error_type = type(e).__name__
-        sys.stderr.write("{0}: {1}\n".format(error_type, e.message))
+        sys.stderr.write("{0}: {1}\n".format(error_type, e))
         sys.exit(1)
 
     if verbose: print(output)
+    if options.get("max_dpi"): print_savings(stats)
 
-def alphachannel_erase(filename):
+def write_pdf(images, output, max_dpi=None, jpeg_quality=85):
+    ######### One image at a time: img2pdf makes its page, and the page goes straight to the file.
+    ######### Returns (images, downsampled images, their bytes before, their bytes after).
     try:
-        img = cv2.imread(filename,cv2.IMREAD_UNCHANGED)
-        if img.shape[2] == 4:
-            img2 = cv2.imread(filename,cv2.IMREAD_COLOR)
-            cv2.imwrite(filename, img2)
-    except Exception as e:
-        error_type = type(e).__name__
-        sys.stderr.write("{0}: {1}\n".format(error_type, e.message))
-        sys.exit(1)
+        with open(output, "wb") as f:
+            writer = PdfStreamWriter(f)
+            sizes = []
+            for data, size in image_pdfs(images, max_dpi, jpeg_quality):
+                writer.add_pdf(data)
+                sizes.append(size)
+            writer.close()
+    except BaseException:
+        ######### No half-written pdf is left behind.
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    return savings(images, sizes)
+
+def append_pdf(images, output, max_dpi=None, jpeg_quality=85):
+    ######### The new pages go after the end of output as an incremental update, so the
+    ######### existing pages are not read or written again. Other pdfs are rewritten by pikepdf.
+    update = read_update(output)
+    if update is None:
+        return rewrite_pdf(images, output, max_dpi, jpeg_quality)
+
+    length = os.path.getsize(output)
+    try:
+        with open(output, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            writer = PdfStreamWriter(f, update)
+            sizes = []
+            for data, size in image_pdfs(images, max_dpi, jpeg_quality):
+                writer.add_pdf(data)
+                sizes.append(size)
+            writer.close()
+    except BaseException:
+        ######### Cut the file back to the pdf it was.
+        with open(output, "r+b") as f:
+            f.truncate(length)
+        raise
+    return savings(images, sizes)
+
+def rewrite_pdf(images, output, max_dpi=None, jpeg_quality=85):
+    tmp_output = output + ".tmp"
+    try:
+        with pikepdf.open(output) as pdf:
+            sizes = []
+            for data, size in image_pdfs(images, max_dpi, jpeg_quality):
+                with pikepdf.open(io.BytesIO(data)) as page_pdf:
+                    pdf.pages.extend(page_pdf.pages)
+                sizes.append(size)
+            pdf.save(tmp_output, encryption=pdf.is_encrypted)
+        os.replace(tmp_output, output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    return savings(images, sizes)
+
+def read_update(path):
+    ######### What PdfStreamWriter needs to append to path, or None when an incremental update
+    ######### is not possible: xref streams, encryption, or a page tree root with inheritable entries.
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - 1024))
+        tail = f.read()
+        start = tail.rfind(b"startxref")
+        if start < 0:
+            return None
+        prev = int(tail[start + 9:].split()[0])
+        f.seek(prev)
+        if f.read(4) != b"xref":
+            return None
+
+    with pikepdf.open(path) as pdf:
+        pages = pdf.Root.Pages
+        if pdf.is_encrypted:
+            return None
+        ######### pikepdf pushes inherited entries down to the pages on open, so the page tree
+        ######### root is checked as it is written in the file.
+        root_keys = raw_keys(path, pages.objgen)
+        if root_keys is None or not root_keys <= {"/Type", "/Kids", "/Count"}:
+            return None
+        trailer = b""
+        if "/Info" in pdf.trailer and pdf.trailer.Info.is_indirect:
+            trailer += b" /Info %d %d R" % pdf.trailer.Info.objgen
+        if "/ID" in pdf.trailer:
+            trailer += b" /ID " + pdf.trailer.ID.unparse()
+        return dict(
+            size=int(pdf.trailer.Size),
+            root=pdf.Root.objgen,
+            pages=pages.objgen,
+            kids=[b"%d %d R" % kid.objgen for kid in pages.Kids],
+            count=int(pages.Count),
+            prev=prev,
+            trailer=trailer,
+        )
+
+def raw_keys(path, objgen):
+    ######### Keys of the last definition of a dictionary object in path, or None when it is not found.
+    header = b"%d %d obj" % objgen
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        end = len(m)
+        while True:
+            start = m.rfind(header, 0, end)
+            if start < 0:
+                return None
+            if start == 0 or m[start - 1:start] in (b" ", b"\t", b"\r", b"\n", b"\f"):
+                break
+            end = start
+        stop = m.find(b"endobj", start)
+        body = m[start + len(header):stop if stop >= 0 else len(m)]
+    try:
+        ######### References need the pdf to resolve, and only the keys are wanted.
+        obj = pikepdf.Object.parse(re.sub(rb"\d+\s+\d+\s+R\b", b"null", body))
+    except Exception:
+        return None
+    return set(obj.keys()) if isinstance(obj, pikepdf.Dictionary) else None
+
+def image_pdfs(images, max_dpi=None, jpeg_quality=85):
+    ######### img2pdf's one-page pdf of each image, with (bytes before, bytes after) when it was downsampled.
+    for image in images:
+        data = downsample(image, max_dpi, jpeg_quality) if max_dpi else None
+        if data is None:
+            yield img2pdf.convert([image_input(image)]), None
+        else:
+            yield img2pdf.convert([data]), (os.path.getsize(image), len(data))
+
+def savings(images, sizes):
+    sizes = [size for size in sizes if size is not None]
+    return len(images), len(sizes), sum(b for b, a in sizes), sum(a for b, a in sizes)
+
+def image_dpi(img):
+    xdpi, ydpi = img.info.get("dpi", (0, 0))
+    return (xdpi if xdpi > 0 else DEFAULT_DPI), (ydpi if ydpi > 0 else DEFAULT_DPI)
+
+def downsample(filename, max_dpi, jpeg_quality):
+    ######### None when the image already fits max_dpi, or when the smaller image is not a smaller file.
+    ######### Only the header is read in the first case.
+    with Image.open(filename) as img:
+        if getattr(img, "n_frames", 1) > 1:
+            return None
+        ######### alphachannel_erase drops the resolution, so those pages are sized at the default.
+        if img.format == "PNG" and png_has_alpha(filename):
+            xdpi, ydpi = DEFAULT_DPI, DEFAULT_DPI
+        else:
+            xdpi, ydpi = image_dpi(img)
+        if xdpi <= max_dpi and ydpi <= max_dpi:
+            return None
+
+        size = (max(1, round(img.width * min(xdpi, max_dpi) / xdpi)), max(1, round(img.height * min(ydpi, max_dpi) / ydpi)))
+        ######### The page keeps its size: the new resolution is the new pixels over the old inches.
+        dpi = (size[0] * xdpi / img.width, size[1] * ydpi / img.height)
+        exif = img.info.get("exif", b"")
+        lossless = img.mode in ("1", "P", "LA")
+        if img.format == "JPEG":
+            img.draft(img.mode, size)
+        bilevel = img.mode == "1"
+        ######### Alpha is dropped, as image_input does for PNGs.
+        img = img.convert({"1": "L", "L": "L", "LA": "L", "CMYK": "CMYK"}.get(img.mode, "RGB"))
+        img = img.resize(size, Image.LANCZOS)
+        if bilevel:
+            ######### Bilevel scans stay 1-bit: thresholded, not dithered.
+            img = img.convert("1", dither=Image.NONE)
+
+        buf = io.BytesIO()
+        if lossless:
+            img.save(buf, "PNG", dpi=dpi, exif=exif)
+        else:
+            img.save(buf, "JPEG", quality=jpeg_quality, dpi=tuple(round(d) for d in dpi), exif=exif)
+        if buf.tell() >= os.path.getsize(filename):
+            return None
+        return buf.getvalue()
+
+class PdfStreamWriter:
+    ######### Writes pages as they come. Only the object offsets and page references stay in memory.
+    ######### In a new file object 1 is the catalog and object 2 is the page tree, both written by close().
+    ######### With update from read_update, the page tree of an existing pdf is replaced by a longer one.
+    def __init__(self, f, update=None):
+        self.f = f
+        self.objects = {}
+        if update is None:
+            self.update = False
+            self.version = "1.3"
+            self.size = 3
+            self.root = (1, 0)
+            self.pages = (2, 0)
+            self.kids = []
+            self.count = 0
+            self.prev = None
+            self.trailer = b""
+            f.write(b"%PDF-1.3\n%\xe2\xe3\xcf\xd3\n")
+        else:
+            self.update = True
+            self.__dict__.update(update)
+            f.write(b"\n")
+
+    def add_pdf(self, data):
+        with pikepdf.open(io.BytesIO(data)) as pdf:
+            refs = {}
+            queue = []
+            if not self.update:
+                self.version = max(self.version, pdf.pdf_version)
+                if not self.trailer and "/Info" in pdf.trailer:
+                    info = self.new_object()
+                    self.write_object(info, self.unparse(pdf.trailer.Info, refs, queue, top=True))
+                    self.trailer = b" /Info %d 0 R" % info
+            for page in pdf.pages:
+                self.kids.append(b"%d 0 R" % self.ref(page.obj, refs, queue))
+                self.count += 1
+            while queue:
+                obj = queue.pop(0)
+                if isinstance(obj, pikepdf.Dictionary) and obj.get("/Type") == "/Page":
+                    items = [(k, v) for k, v in obj.items() if k != "/Parent"]
+                    body = self.unparse_dict(items, refs, queue, b"/Parent %d %d R" % self.pages)
+                else:
+                    body = self.unparse(obj, refs, queue, top=True)
+                if isinstance(obj, pikepdf.Stream):
+                    self.write_object(refs[obj.objgen], body, obj.read_raw_bytes())
+                else:
+                    self.write_object(refs[obj.objgen], body)
+
+    def new_object(self):
+        self.size += 1
+        return self.size - 1
+
+    def ref(self, obj, refs, queue):
+        if obj.objgen not in refs:
+            refs[obj.objgen] = self.new_object()
+            queue.append(obj)
+        return refs[obj.objgen]
+
+    def unparse(self, obj, refs, queue, top=False):
+        if isinstance(obj, pikepdf.Object) and obj.is_indirect and not top:
+            return b"%d 0 R" % self.ref(obj, refs, queue)
+        if isinstance(obj, pikepdf.Stream):
+            items = [(k, v) for k, v in obj.stream_dict.items() if k != "/Length"]
+            items.append(("/Length", len(obj.read_raw_bytes())))
+            return self.unparse_dict(items, refs, queue)
+        if isinstance(obj, pikepdf.Dictionary):
+            return self.unparse_dict(obj.items(), refs, queue)
+        if isinstance(obj, pikepdf.Array):
+            return b"[" + b" ".join(self.unparse(v, refs, queue) for v in obj) + b"]"
+        if isinstance(obj, bool):
+            return b"true" if obj else b"false"
+        if obj is None:
+            return b"null"
+        if isinstance(obj, int):
+            return b"%d" % obj
+        if isinstance(obj, (float, Decimal)):
+            return format(Decimal(str(obj)), "f").encode()
+        return obj.unparse()
+
+    def unparse_dict(self, items, refs, queue, extra=b""):
+        entries = [pikepdf.Name(k).unparse() + b" " + self.unparse(v, refs, queue) for k, v in items]
+        return b"<<" + b" ".join(entries + ([extra] if extra else [])) + b">>"
+
+    def write_object(self, number, body, stream=None, generation=0):
+        self.objects[number] = (self.f.tell(), generation)
+        self.f.write(b"%d %d obj\n" % (number, generation) + body)
+        if stream is not None:
+            self.f.write(b"\nstream\n" + stream + b"\nendstream")
+        self.f.write(b"\nendobj\n")
+
+    def close(self):
+        kids = b" ".join(self.kids)
+        self.write_object(self.pages[0], b"<</Type /Pages /Kids [" + kids + b"] /Count %d>>" % self.count, generation=self.pages[1])
+        if not self.update:
+            self.write_object(1, b"<</Type /Catalog /Pages 2 0 R>>")
+
+        xref = self.f.tell()
+        self.f.write(b"xref\n")
+        if not self.update:
+            self.objects[0] = (0, 65535)
+        numbers = sorted(self.objects)
+        runs = [[numbers[0]]]
+        for number in numbers[1:]:
+            if number == runs[-1][-1] + 1:
+                runs[-1].append(number)
+            else:
+                runs.append([number])
+        for run in runs:
+            self.f.write(b"%d %d\n" % (run[0], len(run)))
+            for number in run:
+                offset, generation = self.objects[number]
+                self.f.write(b"%010d %05d %s \n" % (offset, generation, b"f" if number == 0 else b"n"))
+
+        prev = b"" if self.prev is None else b" /Prev %d" % self.prev
+        self.f.write(b"trailer\n<</Size %d /Root %d %d R%s%s>>\n" % ((self.size,) + self.root + (self.trailer, prev)))
+        self.f.write(b"startxref\n%d\n%%%%EOF\n" % xref)
+        if not self.update:
+            ######### The header has a fixed width, so the version is patched in place.
+            self.f.seek(5)
+            self.f.write(self.version.encode())
+
+def image_input(filename):
+    ######### img2pdf refuses alpha. Only PNGs whose header says alpha are decoded.
+    if filename.endswith(".png") and png_has_alpha(filename):
+        return alphachannel_erase(filename)
+    return filename
+
+def png_has_alpha(filename):
+    ######### IHDR color type 4 (gray + alpha) or 6 (RGBA), or a tRNS chunk before IDAT.
+    with open(filename, "rb") as f:
+        if f.read(8) != b"\x89PNG\r\n\x1a\n":
+            return False
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"IHDR":
+                ihdr = f.read(length)
+                if len(ihdr) < 13:
+                    return False
+                color_type = ihdr[9]
+                if color_type in (4, 6):
+                    return True
+                f.seek(4, os.SEEK_CUR)
+            elif chunk_type == b"tRNS":
+                return True
+            elif chunk_type in (b"IDAT", b"IEND"):
+                return False
+            else:
+                f.seek(length + 4, os.SEEK_CUR)
+
+def alphachannel_erase(filename):
+    ######### Errors go to the caller, which reports them for this file.
+    img = cv2.imread(filename,cv2.IMREAD_COLOR)
+    if img is None:
+        raise OSError("cannot read image: " + filename)
+    ok, buf = cv2.imencode(".png", img)
+    return buf.tobytes()
 
 def makedir(path):
     try:
@@ -100,6 +540,21 @@ def main():
     source = args.source
     split = args.split
     verbose = args.verbose
+    options = dict(max_dpi=args.max_dpi, jpeg_quality=args.jpeg_quality)
+
+    if args.append is not None:
+        if split:
+            print("ERROR: --append cannot be used with --split.")
+            sys.exit(1)
+        if not os.path.exists(source):
+            print("ERROR: Source does not exist.")
+            sys.exit(1)
+        if os.path.dirname(args.append):
+            makedir(os.path.dirname(args.append))
+        if verbose: print("**** Start ****")
+        append_convert_pdf(source, args.append, verbose, **options)
+        if verbose: print("**** Complete! ****")
+        return
 
     output = ""
     destination = "." if args.destination is None else args.destination
@@ -120,42 +575,13 @@ def main():
 
     if verbose: print("**** Start ****")
     if os.path.isfile(source):
-        root, ext = os.path.splitext(source)
-        file_name = os.path.basename(root)
-
-        if ext == ".png":
-            try:
-                with tempfile.TemporaryDirectory() as dname:
-                    shutil.copy(source, dname)
-                    input = os.path.join(dname, file_name + ext)
-                    alphachannel_erase(input)
-                    single_convert_pdf(input, output, source, destination, verbose)
-            except Exception as e:
-                error_type = type(e).__name__
-                sys.stderr.write("{0}: {1}\n".format(error_type, e.message))
-                sys.exit(1)
-
-        else:
-            single_convert_pdf(source, output, source, destination, verbose)
+        single_convert_pdf(source, output, source, destination, verbose, **options)
     
     elif os.path.isdir(source):
-        png_files = glob.glob(source + "/*.png")
-
-        if png_files == []:
-            convert_pdf(source, output, source, destination, split, verbose)
-
-        else:
-            try:
-                with tempfile.TemporaryDirectory() as dname:
-                    shutil.copytree(source, dname, dirs_exist_ok=True)
-                    png_files = glob.glob(dname + "/*.png")
-                    for file in png_files:
-                        alphachannel_erase(file)
-                    convert_pdf(dname, output, source, destination, split, verbose)
-            except Exception as e:
-                error_type = type(e).__name__
-                sys.stderr.write("{0}: {1}\n".format(error_type, e.message))
-                sys.exit(1)
+        failed = convert_pdf(source, output, source, destination, split, verbose, args.jobs, **options)
+        if failed:
+            print("ERROR: %d of %d files failed." % (len(failed), len(glob.glob(source + "/*"))))
+            sys.exit(1)
 
     else:
         print("ERROR: Source does not exist.")
@@ -2,8 +2,13 @@ import sys
 import os
 import argparse
 import glob
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import shutil
 from pathlib import Path
-from pdf2image import convert_from_path
+from PIL import Image, TiffImagePlugin
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 
 def create_parser():
@@ -61,6 +66,68 @@ def create_parser():
         action="store_true",
         help="Output format is webp."
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of poppler processes. For a file the pages are split into this many ranges. For a dir the page ranges of all PDFs share this many workers. Default is the number of CPUs."
+    )
+    parser.add_argument(
+        "--pages",
+        type=page_ranges,
+        default=None,
+        help="Pages to render. ex.) 1-3,7,10- Output file numbers stay the page numbers."
+    )
+    parser.add_argument(
+        "--max-size",
+        type=max_size,
+        default=None,
+        metavar="WxH",
+        help="Lower the dpi so the pages fit in WxH pixels (Wx, xH or N for NxN also work). The first page size is used for the whole PDF."
+    )
+    color = parser.add_mutually_exclusive_group()
+    color.add_argument(
+        "--gray",
+        dest="color",
+        action="store_const",
+        const="gray",
+        help="Render in grayscale."
+    )
+    color.add_argument(
+        "--mono",
+        dest="color",
+        action="store_const",
+        const="mono",
+        help="Render in grayscale and save as 1-bit black and white. Not for jpeg."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not read or write the page cache."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pdftoimg"),
+        help="Page cache dir. Default is ~/.cache/pdftoimg."
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=2048,
+        help="Page cache size limit in MB. The least recently used pages are removed. Default is 2048."
+    )
+    parser.add_argument(
+        "--pil",
+        action="store_true",
+        help="Always encode the pages with PIL. By default poppler writes jpeg and png files itself."
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=0,
+        help="Render and save this many pages at a time, so memory does not grow with the page count. Default is 0 (all pages at once)."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -69,7 +136,12 @@ def create_parser():
     return parser
 
 
-def convert_image(f, dest_dir, fmt, suffix, dpi, multi, verbose):
+######### Formats poppler can write as the final file. TIFF is not here, because
+######### pdf2image cannot ask poppler for deflate compression.
+DIRECT_FORMATS = {"JPEG": "jpeg", "PNG": "png"}
+
+def convert_image(f, dest_dir, fmt, suffix, dpi, multi, verbose, jobs=1, batch=0, pil=False, pages=None, max_size=None, color=None,
+                  cache_dir=None, info=None, digest=None):
     poppler_dir = Path(__file__).parent.absolute() / "poppler/bin"
     os.environ["PATH"] += os.pathsep + str(poppler_dir)
 
@@ -77,29 +149,282 @@ def convert_image(f, dest_dir, fmt, suffix, dpi, multi, verbose):
     name = os.path.basename(root)
 
     try:
-        pages = convert_from_path(str(f), dpi)
-        if multi:
-            file_name = name + suffix
-            image_path = dest_dir + "/" + file_name
-            if verbose: print(end=">")
-            pages[0].save(str(image_path), "TIFF", compression="tiff_deflate", save_all=True, append_images=pages[1:], dpi = (dpi, dpi))
+        ######### pdfinfo and the digest are read once per PDF; convert_all passes them to every unit.
+        if info is None:
+            info = pdfinfo_from_path(str(f))
+        if max_size is not None:
+            dpi = bounded_dpi(f, dpi, max_size, info)
+        direct = fmt in DIRECT_FORMATS and not multi and not pil and color != "mono"
+        cache_key = None
 
-        else:
-            for i, page in enumerate(pages):
-                file_name = name + "_{:03d}".format(i + 1) + suffix
+        if cache_dir is not None:
+            if digest is None:
+                digest = file_digest(f)
+            cache_key = lambda page: make_cache_key(digest, page, dpi, color, fmt, direct)
+
+            if multi:
+                image_path = dest_dir + "/" + name + suffix
+                if cache_get(cache_dir, cache_key("multi:%s" % (pages,)), image_path):
+                    if verbose: print(end=">")
+                    if verbose: print(" <Success>", dest_dir)
+                    return True
+
+            else:
+                ######### Only pages that are not cached are rendered.
+                missing = []
+                for number in page_numbers(f, pages, info):
+                    image_path = dest_dir + "/" + name + "_{:03d}".format(number) + suffix
+                    if cache_get(cache_dir, cache_key(number), image_path):
+                        if verbose: print(end=">")
+                    else:
+                        missing.append(number)
+                if not missing:
+                    if verbose: print(" <Success>", dest_dir)
+                    return True
+                pages = to_ranges(missing)
+
+        render = dict(jobs=jobs, batch=batch, pages=pages, grayscale=color is not None, info=info)
+
+        if direct:
+            ######### Poppler encodes the file, it is only renamed here.
+            with tempfile.TemporaryDirectory(dir=dest_dir) as tmp_dir:
+                for number, path in render_files(f, dpi, DIRECT_FORMATS[fmt], tmp_dir, **render):
+                    file_name = name + "_{:03d}".format(number) + suffix
+                    if verbose: print(end=">")
+                    os.replace(path, dest_dir + "/" + file_name)
+                    if cache_key is not None:
+                        cache_put(cache_dir, cache_key(number), dest_dir + "/" + file_name)
+            if verbose: print(" <Success>", dest_dir)
+            return True
+
+        with tempfile.TemporaryDirectory(dir=dest_dir) as tmp_dir:
+            rendered = render_pages(f, dpi, tmp_dir, **render)
+            if color == "mono":
+                rendered = ((number, page.convert("1")) for number, page in rendered)
+
+            if multi:
+                file_name = name + suffix
                 image_path = dest_dir + "/" + file_name
                 if verbose: print(end=">")
-                if fmt == "TIFF":
-                    page.save(str(image_path), "TIFF", compression="tiff_deflate", dpi = (dpi, dpi))
+                ######### Same file as save_all=True, but pages are appended as they arrive.
+                with TiffImagePlugin.AppendingTiffWriter(str(image_path), True) as tf:
+                    for number, page in rendered:
+                        page.save(tf, "TIFF", compression="tiff_deflate", dpi = (dpi, dpi))
+                        tf.newFrame()
+                if cache_key is not None:
+                    cache_put(cache_dir, cache_key("multi:%s" % (pages,)), image_path)
+
+            else:
+                for number, page in rendered:
+                    file_name = name + "_{:03d}".format(number) + suffix
+                    image_path = dest_dir + "/" + file_name
+                    if verbose: print(end=">")
+                    if fmt == "TIFF":
+                        page.save(str(image_path), "TIFF", compression="tiff_deflate", dpi = (dpi, dpi))
 
-                else:
-                    page.save(str(image_path), fmt, dpi = (dpi, dpi))
+                    else:
+                        page.save(str(image_path), fmt, dpi = (dpi, dpi))
+                    if cache_key is not None:
+                        cache_put(cache_dir, cache_key(number), image_path)
         
         if verbose: print(" <Success>", dest_dir)
+        return True
 
-    except OSError as e:
-        print("Error: " + f.title)
-        pass
+    except Exception as e:
+        print("Error: " + f)
+        return False
+
+def convert_all(files, dest_dir, fmt, suffix, dpi, multi, verbose, jobs, batch=0, pages=None, **options):
+    ######### Count the pages of every PDF first, then feed (pdf, page range) units of
+    ######### all PDFs to one pool, largest PDF first. A multipage TIFF is one unit.
+    counted = []
+    failed = []
+    known = {}
+    for f in files:
+        try:
+            info = pdfinfo_from_path(str(f))
+            digest = file_digest(f) if options.get("cache_dir") is not None else None
+            known[f] = dict(info=info, digest=digest)
+            counted.append((f, page_numbers(f, pages, info)))
+        except Exception as e:
+            print("Error: " + f)
+            failed.append(f)
+
+    total = sum(len(numbers) for f, numbers in counted)
+    unit_pages = batch if batch > 0 else max(1, min(16, -(-total // (jobs * 4))))
+    units = []
+    remaining = {}
+    for f, numbers in sorted(counted, key=lambda c: len(c[1]), reverse=True):
+        chunks = [pages] if multi else [[r] for r in split_ranges(to_ranges(numbers), unit_pages)]
+        units.extend((f, chunk) for chunk in chunks)
+        remaining[f] = len(chunks)
+        if not chunks and verbose: print(f, "> <Success>", dest_dir)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(convert_image, f, dest_dir, fmt, suffix, dpi, multi, False, 1, 0,
+                                   pages=chunk, **known[f], **options): f for f, chunk in units}
+        for future in as_completed(futures):
+            f = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                print("Error: " + f)
+                ok = False
+            if not ok and f not in failed:
+                failed.append(f)
+
+            remaining[f] -= 1
+            if remaining[f] == 0 and f not in failed:
+                if verbose: print(f, "> <Success>", dest_dir)
+
+    return failed
+
+def split_ranges(ranges, size):
+    ######### ex.) [(1, 5), (9, 9)], 2 -> [(1, 2), (3, 4), (5, 5), (9, 9)]
+    for first_page, last_page in ranges:
+        for start in range(first_page, last_page + 1, size):
+            yield start, min(start + size - 1, last_page)
+
+def render_pages(f, dpi, output_folder, jobs=1, batch=0, pages=None, grayscale=False, info=None):
+    ######### Poppler writes the pages to files, so the pdftoppm workers run side by side; through
+    ######### pipes pdf2image reads them one after another. Each page is read back and removed.
+    for number, path in render_files(f, dpi, "ppm", output_folder, jobs, batch, pages, grayscale, info):
+        with Image.open(path) as page:
+            page.load()
+        os.remove(path)
+        yield number, page
+
+def render_files(f, dpi, poppler_fmt, output_folder, jobs=1, batch=0, pages=None, grayscale=False, info=None):
+    ######### Paths come back in page order, and each batch has new uuid names.
+    for first_page, last_page in page_batches(f, batch, pages, info):
+        paths = convert_from_path(str(f), dpi, first_page=first_page, last_page=last_page, thread_count=jobs,
+                                  grayscale=grayscale, output_folder=output_folder, fmt=poppler_fmt, paths_only=True)
+        yield from enumerate(paths, first_page or 1)
+
+def page_batches(f, batch=0, pages=None, info=None):
+    if batch <= 0 and pages is None:
+        yield None, None
+        return
+
+    ######### Only one batch of pages is held in memory at a time.
+    page_count = (info or pdfinfo_from_path(str(f)))["Pages"]
+    for first_page, last_page in pages or [(1, page_count)]:
+        last_page = page_count if last_page is None else min(last_page, page_count)
+        if first_page > last_page:
+            continue
+        step = batch if batch > 0 else last_page - first_page + 1
+        for start in range(first_page, last_page + 1, step):
+            yield start, min(start + step - 1, last_page)
+
+def page_numbers(f, pages=None, info=None):
+    page_count = (info or pdfinfo_from_path(str(f)))["Pages"]
+    numbers = []
+    for first_page, last_page in pages or [(1, page_count)]:
+        last_page = page_count if last_page is None else min(last_page, page_count)
+        numbers.extend(range(first_page, last_page + 1))
+    return numbers
+
+def to_ranges(numbers):
+    ######### ex.) [1, 2, 3, 7] -> [(1, 3), (7, 7)]
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1] = (ranges[-1][0], number)
+        else:
+            ranges.append((number, number))
+    return ranges
+
+def bounded_dpi(f, dpi, max_size, info=None):
+    ######### Lower the dpi so the first page fits in max_size. No pixels outside it are rendered.
+    info = info or pdfinfo_from_path(str(f))
+    width_pt, height_pt = (float(v) for v in info["Page size"].split()[0:3:2])
+    if int(info.get("Page rot", 0)) % 180 == 90:
+        width_pt, height_pt = height_pt, width_pt
+
+    max_width, max_height = max_size
+    limits = [dpi]
+    if max_width is not None:
+        limits.append(max_width * 72 / width_pt)
+    if max_height is not None:
+        limits.append(max_height * 72 / height_pt)
+    return max(1, int(min(limits)))
+
+def file_digest(f):
+    h = hashlib.sha256()
+    with open(f, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_cache_key(digest, page, dpi, color, fmt, direct):
+    ######### Everything that changes the output bytes is part of the key.
+    encoder = "poppler" if direct else "pil"
+    return hashlib.sha256("|".join(map(str, [digest, page, dpi, color or "rgb", fmt, encoder])).encode()).hexdigest()
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+def cache_get(cache_dir, key, dest):
+    path = cache_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return False
+    ######### mtime is the LRU clock.
+    os.utime(path)
+    shutil.copyfile(path, dest)
+    return True
+
+def cache_put(cache_dir, key, src):
+    ######### Copied, not hard-linked, so rewriting an output in place cannot change the cache.
+    path = cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".%d.tmp" % os.getpid()
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, path)
+
+def cache_evict(cache_dir, max_bytes):
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, "*", "*")):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def page_ranges(s):
+    ######### ex.) "1-3,7,10-" -> [(1, 3), (7, 7), (10, None)]
+    ranges = []
+    try:
+        for part in s.split(","):
+            first, sep, last = part.partition("-")
+            first = int(first)
+            last = first if not sep else None if last.strip() == "" else int(last)
+            if first < 1 or (last is not None and last < first):
+                raise ValueError
+            ranges.append((first, last))
+    except ValueError:
+        raise argparse.ArgumentTypeError("page ranges like 1-3,7,10- expected, got " + repr(s))
+    return ranges
+
+def max_size(s):
+    ######### ex.) "800" -> (800, 800), "800x600" -> (800, 600), "800x" -> (800, None)
+    try:
+        width, sep, height = s.lower().partition("x")
+        size = (int(width) if width else None, int(height) if height else None) if sep else (int(s), int(s))
+        if size == (None, None) or any(v is not None and v < 1 for v in size):
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError("WxH, Wx, xH or N expected, got " + repr(s))
+    return size
 
 
 def main():
@@ -124,6 +449,10 @@ def main():
         print("Error: Any one of jpeg, png, tiff, multipage tiff, gif, bmp, webp.")
         sys.exit(1)
 
+    if args.color == "mono" and fmt == "JPEG":
+        print("Error: Mono output cannot be jpeg.")
+        sys.exit(1)
+
     dest_dir = "." if args.destination is None else args.destination
     try:
         os.makedirs(dest_dir, exist_ok=True)
@@ -131,24 +460,42 @@ def main():
         print("ERROR: Destination is " + e.filename)
         sys.exit(1)
 
+    cache_dir = None if args.no_cache else args.cache_dir
+
     if os.path.isfile(args.source):
         root, ext = os.path.splitext(args.source)
         if ext != ".pdf":
             print("Error: PDF file does not exist.")
             sys.exit(1)
         if verbose: print(args.source, end=" > ")
-        convert_image(args.source, dest_dir, fmt, suffix, dpi, m, verbose)
+        ok = convert_image(args.source, dest_dir, fmt, suffix, dpi, m, verbose, args.jobs, args.batch, args.pil,
+                           args.pages, args.max_size, args.color, cache_dir)
+        failed = [] if ok else [args.source]
     
     elif os.path.isdir(args.source):
-        files = glob.glob(args.source + "/*.pdf")
-        for f in files:
-            if verbose: print(f, end=" ")
-            convert_image(f, dest_dir, fmt, suffix, dpi, m, verbose)
+        files = sorted(glob.glob(args.source + "/*.pdf"))
+        if args.jobs > 1 and len(files) > 1:
+            failed = convert_all(files, dest_dir, fmt, suffix, dpi, m, verbose, args.jobs, args.batch, args.pages,
+                                 pil=args.pil, max_size=args.max_size, color=args.color, cache_dir=cache_dir)
+        else:
+            failed = []
+            for f in files:
+                if verbose: print(f, end=" ")
+                if not convert_image(f, dest_dir, fmt, suffix, dpi, m, verbose, args.jobs, args.batch, args.pil,
+                                     args.pages, args.max_size, args.color, cache_dir):
+                    failed.append(f)
+        if failed:
+            print("ERROR: %d of %d files failed." % (len(failed), len(files)))
 
     else:
         print("ERROR: Source file or dir does not exist.")
         sys.exit(1)
 
+    if cache_dir is not None:
+        cache_evict(cache_dir, args.cache_size * 1024 * 1024)
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,350 @@
+import pytest
+import os
+import io
+import sys
+import shutil
+import img2pdf
+import pikepdf
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import imgtopdf
+from imgtopdf import (
+    write_pdf,
+    append_pdf,
+    append_convert_pdf,
+    read_update,
+    read_manifest,
+    png_has_alpha,
+    image_input,
+    split_all,
+    downsample,
+)
+
+
+def noise(mode, size=(61, 43), seed=0):
+    rng = np.random.default_rng(seed)
+    if mode == "1":
+        return Image.fromarray(rng.integers(0, 2, size[::-1], dtype=np.uint8) * 255).convert("1")
+    if mode == "P":
+        return Image.fromarray(rng.integers(0, 256, size[::-1] + (3,), dtype=np.uint8)).quantize(16)
+    bands = len(mode)
+    return Image.frombytes(mode, size, rng.integers(0, 256, size[0] * size[1] * bands, dtype=np.uint8).tobytes())
+
+def save_jpeg(path):
+    noise("RGB").save(path, "JPEG", dpi=(300, 300))
+
+def save_rgba(path):
+    noise("RGBA").save(path, "PNG")
+
+def save_1bit(path):
+    noise("1").save(path, "PNG", dpi=(200, 200))
+
+def save_palette_trns(path):
+    noise("P").save(path, "PNG", transparency=3)
+
+def save_cmyk(path):
+    noise("CMYK").save(path, "JPEG", dpi=(150, 150))
+
+SAMPLES = {
+    "photo.jpg": save_jpeg,
+    "rgba.png": save_rgba,
+    "mono.png": save_1bit,
+    "palette.png": save_palette_trns,
+    "cmyk.jpg": save_cmyk,
+}
+
+@pytest.fixture
+def samples(tmp_path):
+    paths = {}
+    for name, save in SAMPLES.items():
+        paths[name] = str(tmp_path / name)
+        save(paths[name])
+    return paths
+
+def reference_input(path):
+    # img2pdf refuses alpha; what is left after dropping it is the reference.
+    with Image.open(path) as img:
+        if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+            buf = io.BytesIO()
+            Image.frombytes("RGB", img.size, img.convert("RGB").tobytes()).save(buf, "PNG")
+            return buf.getvalue()
+    return path
+
+def pages(pdf):
+    result = []
+    for page in pdf.pages:
+        (name, raw), = page.Resources.XObject.items()
+        pixels = pikepdf.PdfImage(raw).as_pil_image()
+        result.append(([float(v) for v in page.MediaBox], pixels.mode, pixels.size, pixels.tobytes()))
+    return result
+
+@pytest.mark.parametrize('name', list(SAMPLES))
+def test_write_pdf_matches_img2pdf(samples, tmp_path, name):
+    output = tmp_path / "out.pdf"
+
+    stats = write_pdf([samples[name]], str(output))
+
+    assert stats == (1, 0, 0, 0)
+    with pikepdf.open(output) as pdf, pikepdf.open(io.BytesIO(img2pdf.convert([reference_input(samples[name])]))) as ref:
+        assert pdf.check_pdf_syntax() == []
+        assert len(pdf.pages) == len(ref.pages) == 1
+        assert pages(pdf) == pages(ref)
+
+def test_write_pdf_many(samples, tmp_path):
+    images = [samples[name] for name in SAMPLES] * 3
+    output = tmp_path / "out.pdf"
+
+    write_pdf(images, str(output))
+
+    with pikepdf.open(output) as pdf, pikepdf.open(io.BytesIO(img2pdf.convert([reference_input(i) for i in images]))) as ref:
+        assert pdf.check_pdf_syntax() == []
+        assert len(pdf.pages) == len(images)
+        assert pages(pdf) == pages(ref)
+
+def test_write_pdf_failure(samples, tmp_path):
+    bad = tmp_path / "bad.jpg"
+    bad.write_bytes(b"not an image")
+    output = tmp_path / "out.pdf"
+
+    with pytest.raises(Exception):
+        write_pdf([samples["photo.jpg"], str(bad)], str(output))
+    assert not output.exists()
+
+
+def assert_pages(output, images):
+    with pikepdf.open(output) as pdf, pikepdf.open(io.BytesIO(img2pdf.convert([reference_input(i) for i in images]))) as ref:
+        assert pdf.check_pdf_syntax() == []
+        assert len(pdf.pages) == len(images)
+        assert pages(pdf) == pages(ref)
+
+@pytest.fixture
+def rewrites(monkeypatch):
+    calls = []
+    rewrite_pdf = imgtopdf.rewrite_pdf
+    def spy(images, output, *args):
+        calls.append(output)
+        return rewrite_pdf(images, output, *args)
+    monkeypatch.setattr(imgtopdf, "rewrite_pdf", spy)
+    return calls
+
+def test_append_pdf(samples, tmp_path, rewrites):
+    first = [samples["photo.jpg"], samples["mono.png"]]
+    second = [samples["rgba.png"], samples["cmyk.jpg"]]
+    output = tmp_path / "out.pdf"
+    write_pdf(first, str(output))
+    original = output.read_bytes()
+
+    assert read_update(str(output)) is not None
+    append_pdf(second, str(output))
+    append_pdf([samples["palette.png"]], str(output))
+
+    assert rewrites == []
+    assert output.read_bytes().startswith(original)
+    assert_pages(output, first + second + [samples["palette.png"]])
+
+def test_append_convert_pdf(samples, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    for name in ["photo.jpg", "mono.png"]:
+        os.replace(samples[name], src / name)
+    output = tmp_path / "out.pdf"
+
+    append_convert_pdf(str(src), str(output), False)
+    original = output.read_bytes()
+    os.replace(samples["cmyk.jpg"], src / "zz.jpg")
+    append_convert_pdf(str(src), str(output), False)
+    appended = output.read_bytes()
+
+    assert appended.startswith(original) and len(appended) > len(original)
+    assert read_manifest(str(output) + ".manifest.json") == ["mono.png", "photo.jpg", "zz.jpg"]
+    assert_pages(output, [str(src / "mono.png"), str(src / "photo.jpg"), str(src / "zz.jpg")])
+
+    # Nothing new: the PDF and the manifest are left alone.
+    manifest = (tmp_path / "out.pdf.manifest.json").read_bytes()
+    append_convert_pdf(str(src), str(output), False)
+    assert output.read_bytes() == appended
+    assert (tmp_path / "out.pdf.manifest.json").read_bytes() == manifest
+
+def test_append_convert_pdf_without_manifest(samples, tmp_path, capsys):
+    # A pdf made without --append has no manifest; appending would add its images again.
+    src = tmp_path / "src"
+    src.mkdir()
+    for name in ["photo.jpg", "mono.png"]:
+        os.replace(samples[name], src / name)
+    output = tmp_path / "out.pdf"
+    write_pdf([str(src / "mono.png"), str(src / "photo.jpg")], str(output))
+    original = output.read_bytes()
+
+    with pytest.raises(SystemExit) as e:
+        append_convert_pdf(str(src), str(output), False)
+    assert e.value.code == 1
+    assert capsys.readouterr().out == "ERROR: " + str(output) + " exists without out.pdf.manifest.json.\n"
+    assert output.read_bytes() == original
+    assert not (tmp_path / "out.pdf.manifest.json").exists()
+
+def inherited_pages(path):
+    # MediaBox on the page tree root is inherited by every page.
+    # pdf.pages would push it back down to the pages, so the tree is edited through /Kids.
+    with pikepdf.open(path, allow_overwriting_input=True) as pdf:
+        page = pdf.Root.Pages.Kids[0]
+        pdf.Root.Pages.MediaBox = page.MediaBox
+        del page["/MediaBox"]
+        pdf.save(path)
+
+def xref_stream(path):
+    with pikepdf.open(path, allow_overwriting_input=True) as pdf:
+        pdf.save(path, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+
+@pytest.mark.parametrize('prepare', [inherited_pages, xref_stream])
+def test_append_pdf_rewrite(samples, tmp_path, rewrites, prepare):
+    output = tmp_path / "out.pdf"
+    write_pdf([samples["photo.jpg"]], str(output))
+    prepare(str(output))
+
+    assert read_update(str(output)) is None
+    append_pdf([samples["mono.png"]], str(output))
+
+    assert rewrites == [str(output)]
+    assert not os.path.exists(str(output) + ".tmp")
+    assert_pages(output, [samples["photo.jpg"], samples["mono.png"]])
+
+def test_append_pdf_encrypted(samples, tmp_path, rewrites):
+    output = tmp_path / "concept1.pdf"
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), "pdf", "concept1.pdf"), output)
+    with pikepdf.open(output) as pdf:
+        count = len(pdf.pages)
+
+    append_pdf([samples["photo.jpg"]], str(output))
+
+    assert rewrites == [str(output)]
+    with pikepdf.open(output) as pdf:
+        assert pdf.is_encrypted
+        assert pdf.check_pdf_syntax() == []
+        assert len(pdf.pages) == count + 1
+
+def test_append_pdf_failure(samples, tmp_path):
+    bad = tmp_path / "bad.jpg"
+    bad.write_bytes(b"not an image")
+    output = tmp_path / "out.pdf"
+    write_pdf([samples["photo.jpg"]], str(output))
+    original = output.read_bytes()
+
+    with pytest.raises(Exception):
+        append_pdf([samples["mono.png"], str(bad)], str(output))
+
+    assert output.read_bytes() == original
+    assert_pages(output, [samples["photo.jpg"]])
+
+@pytest.mark.parametrize(('mode', 'info', 'expected'), [
+    ("RGB", {}, False),
+    ("L", {}, False),
+    ("1", {}, False),
+    ("P", {}, False),
+    ("RGBA", {}, True),
+    ("LA", {}, True),
+    ("P", {"transparency": 3}, True),
+    ("RGB", {"transparency": (1, 2, 3)}, True),
+    ("L", {"transparency": 7}, True),
+])
+def test_png_has_alpha(tmp_path, mode, info, expected):
+    path = tmp_path / "a.png"
+    noise(mode if mode != "LA" else "LA").save(path, "PNG", **info)
+    assert png_has_alpha(str(path)) == expected
+
+def test_png_has_alpha_not_png(samples, tmp_path):
+    assert not png_has_alpha(samples["photo.jpg"])
+    empty = tmp_path / "empty.png"
+    empty.write_bytes(b"")
+    assert not png_has_alpha(str(empty))
+    # A truncated file ends the chunk walk instead of failing.
+    truncated = tmp_path / "truncated.png"
+    truncated.write_bytes(open(samples["mono.png"], "rb").read()[:20])
+    assert not png_has_alpha(str(truncated))
+
+def test_image_input(samples):
+    for name in ["photo.jpg", "mono.png", "cmyk.jpg"]:
+        assert image_input(samples[name]) == samples[name]
+    for name in ["rgba.png", "palette.png"]:
+        data = image_input(samples[name])
+        with Image.open(io.BytesIO(data)) as img, Image.open(samples[name]) as original:
+            assert img.mode == "RGB"
+            assert img.tobytes() == original.convert("RGB").tobytes()
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_split_all(samples, tmp_path, capsys, jobs):
+    bad = tmp_path / "bad.jpg"
+    bad.write_bytes(b"not an image")
+    files = [samples["photo.jpg"], str(bad), samples["rgba.png"], samples["cmyk.jpg"]]
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    failed = split_all(files, str(dst), True, jobs)
+
+    assert failed == [str(bad)]
+    assert sorted(os.listdir(dst)) == ["cmyk.pdf", "photo.pdf", "rgba.pdf"]
+    for f in [samples["photo.jpg"], samples["rgba.png"]]:
+        assert_pages(dst / (os.path.splitext(os.path.basename(f))[0] + ".pdf"), [f])
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [f + " > " + str(dst / os.path.splitext(os.path.basename(f))[0]) + ".pdf"
+                                for f in files if f != str(bad)]
+    assert err.startswith(str(bad) + ": ")
+    assert len(err.splitlines()) == 1
+
+@pytest.mark.parametrize(('name', 'max_dpi', 'expected'), [
+    ("photo.jpg", 300, None),
+    ("photo.jpg", 1000, None),
+    ("photo.jpg", 150, ("JPEG", "RGB", (30, 22))),
+    ("cmyk.jpg", 75, ("JPEG", "CMYK", (30, 22))),
+    # Lossless sources stay lossless.
+    ("mono.png", 100, ("PNG", "1", (31, 22))),
+    ("palette.png", 24, ("PNG", "RGB", (15, 11))),
+    # Not smaller than the original file: the original is kept.
+    ("palette.png", 48, None),
+    # No resolution, or alpha: the default 96 dpi.
+    ("rgba.png", 96, None),
+    ("rgba.png", 48, ("JPEG", "RGB", (30, 22))),
+])
+def test_downsample(samples, name, max_dpi, expected):
+    data = downsample(samples[name], max_dpi, 85)
+    if expected is None:
+        assert data is None
+        return
+    with Image.open(io.BytesIO(data)) as img:
+        assert (img.format, img.mode, img.size) == expected
+
+def test_downsample_bilevel(tmp_path):
+    # A mostly white 1-bit scan stays 1-bit, and gets smaller, after downsampling.
+    a = np.full((1200, 800), 255, dtype=np.uint8)
+    a[100:1100:20, 100:700] = 0
+    a[100:1100, 380:420] = 0
+    path = tmp_path / "scan.png"
+    Image.fromarray(a).convert("1").save(path, dpi=(600, 600))
+    data = downsample(str(path), 300, 85)
+    assert len(data) < os.path.getsize(path)
+    with Image.open(io.BytesIO(data)) as img:
+        assert (img.mode, img.size) == ("1", (400, 600))
+        assert img.getpixel((200, 300)) == 0 and img.getpixel((100, 55)) == 255
+
+def test_downsample_animated(tmp_path):
+    path = tmp_path / "anim.gif"
+    frames = [noise("P", seed=n) for n in range(3)]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+    assert downsample(str(path), 10, 85) is None
+
+@pytest.mark.parametrize('name', list(SAMPLES))
+def test_write_pdf_max_dpi(samples, tmp_path, name):
+    # Downsampled pages keep their size on paper, up to whole dpi: JFIF and img2pdf do not keep fractions.
+    full = tmp_path / "full.pdf"
+    small = tmp_path / "small.pdf"
+    write_pdf([samples[name]], str(full))
+
+    images, count, before, after = write_pdf([samples[name]], str(small), max_dpi=40)
+
+    assert (images, count) == (1, 1)
+    assert before == os.path.getsize(samples[name]) and after > 0
+    with pikepdf.open(full) as a, pikepdf.open(small) as b:
+        assert b.check_pdf_syntax() == []
+        assert [float(v) for v in b.pages[0].MediaBox] == pytest.approx([float(v) for v in a.pages[0].MediaBox], rel=1 / 40)
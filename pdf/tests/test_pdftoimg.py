@@ -0,0 +1,315 @@
+import pytest
+import os
+import sys
+import argparse
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pdftoimg
+from pdftoimg import (
+    page_ranges,
+    max_size,
+    bounded_dpi,
+    convert_image,
+    page_batches,
+    to_ranges,
+    make_cache_key,
+    cache_path,
+    cache_put,
+    cache_evict,
+    split_ranges,
+    convert_all,
+)
+
+
+# A4 portrait in points, as pdfinfo reports it.
+A4_INFO = {"Pages": 12, "Page size": "595.276 x 841.89 pts (A4)", "Page rot": 0}
+
+
+class FakePoppler:
+    # Stands in for pdfinfo and pdftoppm: page N is a flat image of gray level 10 * N.
+    def __init__(self, info=A4_INFO):
+        self.info = info
+        self.pdfinfo_calls = 0
+        self.calls = []
+        self.log = None
+
+    def pdfinfo_from_path(self, f):
+        self.pdfinfo_calls += 1
+        if self.log is not None:
+            # Pool workers are forked, so calls are counted in a file.
+            with open(self.log, "a") as log:
+                log.write(os.path.basename(f) + "\n")
+        if os.path.basename(f).startswith("bad"):
+            raise ValueError("Unable to get page count.")
+        return self.info
+
+    def convert_from_path(self, f, dpi, first_page=None, last_page=None, thread_count=1, grayscale=False,
+                          output_folder=None, fmt="ppm", paths_only=False):
+        self.calls.append(dict(dpi=dpi, first_page=first_page, last_page=last_page, thread_count=thread_count,
+                               grayscale=grayscale, fmt=fmt, paths_only=paths_only))
+        first_page = first_page or 1
+        last_page = last_page or self.info["Pages"]
+        images = [Image.new("L" if grayscale else "RGB", (20, 30), (10 * n,) * (1 if grayscale else 3))
+                  for n in range(first_page, last_page + 1)]
+        if not paths_only:
+            return images
+        paths = []
+        for n, img in zip(range(first_page, last_page + 1), images):
+            paths.append(os.path.join(output_folder, "uuid-%d.%s" % (n, fmt)))
+            img.save(paths[-1])
+        return paths
+
+@pytest.fixture
+def poppler(monkeypatch):
+    fake = FakePoppler()
+    monkeypatch.setattr(pdftoimg, "pdfinfo_from_path", fake.pdfinfo_from_path)
+    monkeypatch.setattr(pdftoimg, "convert_from_path", fake.convert_from_path)
+    return fake
+
+@pytest.mark.parametrize(('s', 'expected'), [
+    ("1", [(1, 1)]),
+    ("1-3", [(1, 3)]),
+    ("10-", [(10, None)]),
+    ("1-3,7,10-", [(1, 3), (7, 7), (10, None)]),
+    ("2-2", [(2, 2)]),
+    (" 4 - 5 ", [(4, 5)]),
+])
+def test_page_ranges(s, expected):
+    assert page_ranges(s) == expected
+
+@pytest.mark.parametrize('s', ["", "0", "-3", "3-1", "a", "1,,2", "1-2-3", "1.5"])
+def test_page_ranges_rejects(s):
+    with pytest.raises(argparse.ArgumentTypeError):
+        page_ranges(s)
+
+@pytest.mark.parametrize(('s', 'expected'), [
+    ("800", (800, 800)),
+    ("800x600", (800, 600)),
+    ("800X600", (800, 600)),
+    ("800x", (800, None)),
+    ("x600", (None, 600)),
+])
+def test_max_size(s, expected):
+    assert max_size(s) == expected
+
+@pytest.mark.parametrize('s', ["", "x", "0", "0x100", "100x0", "-5", "axb", "1.5x2"])
+def test_max_size_rejects(s):
+    with pytest.raises(argparse.ArgumentTypeError):
+        max_size(s)
+
+@pytest.mark.parametrize(('dpi', 'size', 'rot', 'expected'), [
+    # 595.276 x 841.89 pt is 8.27 x 11.69 in.
+    (200, (800, 800), 0, 68),
+    (200, (800, None), 0, 96),
+    (200, (None, 800), 0, 68),
+    (50, (800, 800), 0, 50),
+    (200, (100000, 100000), 0, 200),
+    # Rotated pages swap width and height.
+    (200, (800, None), 90, 68),
+    (200, (None, 800), 270, 96),
+    (200, (1, 1), 0, 1),
+])
+def test_bounded_dpi(monkeypatch, dpi, size, rot, expected):
+    info = dict(A4_INFO, **{"Page rot": rot})
+    monkeypatch.setattr(pdftoimg, "pdfinfo_from_path", lambda f: info)
+    assert bounded_dpi("a.pdf", dpi, size) == expected
+    assert bounded_dpi("a.pdf", dpi, size, info) == expected
+
+@pytest.mark.parametrize(('color', 'suffix', 'fmt', 'mode'), [
+    (None, ".tif", "TIFF", "RGB"),
+    ("gray", ".tif", "TIFF", "L"),
+    ("mono", ".png", "PNG", "1"),
+])
+def test_convert_image_color(poppler, tmp_path, color, suffix, fmt, mode):
+    assert convert_image("doc.pdf", str(tmp_path), fmt, suffix, 200, False, False, pages=[(2, 3)], color=color)
+    assert sorted(os.listdir(tmp_path)) == ["doc_002" + suffix, "doc_003" + suffix]
+    with Image.open(tmp_path / ("doc_003" + suffix)) as img:
+        assert img.mode == mode
+    assert [c["grayscale"] for c in poppler.calls] == [color is not None]
+
+def test_convert_image_max_size(poppler, tmp_path):
+    assert convert_image("doc.pdf", str(tmp_path), "TIFF", ".tif", 200, False, False, pages=[(1, 1)], max_size=(800, 800))
+    assert [c["dpi"] for c in poppler.calls] == [68]
+
+def page_level(path):
+    with Image.open(path) as img:
+        return img.convert("L").getpixel((0, 0))
+
+def test_convert_image_jobs(poppler, tmp_path):
+    assert convert_image("doc.pdf", str(tmp_path), "TIFF", ".tif", 200, False, False, jobs=4)
+    assert [c["thread_count"] for c in poppler.calls] == [4]
+    # Poppler writes files, so its workers are not read one pipe at a time; the temporary dir is removed.
+    assert [c["paths_only"] for c in poppler.calls] == [True]
+    assert sorted(os.listdir(tmp_path)) == ["doc_%03d.tif" % n for n in range(1, 13)]
+    assert [page_level(tmp_path / ("doc_%03d.tif" % n)) for n in range(1, 13)] == [10 * n for n in range(1, 13)]
+
+def test_convert_image_multipage(poppler, tmp_path):
+    assert convert_image("doc.pdf", str(tmp_path), "TIFF", ".tif", 200, True, False, jobs=4)
+    assert os.listdir(tmp_path) == ["doc.tif"]
+    with Image.open(tmp_path / "doc.tif") as img:
+        assert img.n_frames == 12
+        levels = []
+        for n in range(img.n_frames):
+            img.seek(n)
+            levels.append(img.convert("L").getpixel((0, 0)))
+    assert levels == [10 * n for n in range(1, 13)]
+
+@pytest.mark.parametrize(('batch', 'pages', 'expected'), [
+    (0, None, [(None, None)]),
+    (5, None, [(1, 5), (6, 10), (11, 12)]),
+    (12, None, [(1, 12)]),
+    (100, None, [(1, 12)]),
+    (0, [(2, 4), (9, None)], [(2, 4), (9, 12)]),
+    (2, [(2, 4), (9, None)], [(2, 3), (4, 4), (9, 10), (11, 12)]),
+    # Ranges past the last page are cut at the page count.
+    (0, [(10, 20)], [(10, 12)]),
+    (0, [(20, None)], []),
+])
+def test_page_batches(batch, pages, expected):
+    assert list(page_batches("doc.pdf", batch, pages, A4_INFO)) == expected
+
+def test_convert_image_batch(poppler, tmp_path):
+    assert convert_image("doc.pdf", str(tmp_path), "TIFF", ".tif", 200, False, False, batch=5)
+    assert [(c["first_page"], c["last_page"]) for c in poppler.calls] == [(1, 5), (6, 10), (11, 12)]
+    assert [page_level(tmp_path / ("doc_%03d.tif" % n)) for n in range(1, 13)] == [10 * n for n in range(1, 13)]
+
+@pytest.mark.parametrize(('fmt', 'suffix', 'pil', 'color', 'poppler_fmt'), [
+    ("PNG", ".png", False, None, "png"),
+    ("JPEG", ".jpg", False, "gray", "jpeg"),
+    ("PNG", ".png", True, None, "ppm"),
+    ("PNG", ".png", False, "mono", "ppm"),
+    ("TIFF", ".tif", False, None, "ppm"),
+])
+def test_convert_image_direct(poppler, tmp_path, fmt, suffix, pil, color, poppler_fmt):
+    assert convert_image("doc.pdf", str(tmp_path), fmt, suffix, 200, False, False, pages=[(1, 3)], pil=pil, color=color)
+    assert [c["fmt"] for c in poppler.calls] == [poppler_fmt]
+    # Poppler's files are renamed into place; no temporary dir is left.
+    assert sorted(os.listdir(tmp_path)) == ["doc_%03d%s" % (n, suffix) for n in range(1, 4)]
+    with Image.open(tmp_path / ("doc_002" + suffix)) as img:
+        assert img.format == fmt
+    if color != "mono":
+        assert page_level(tmp_path / ("doc_002" + suffix)) == 20
+
+@pytest.mark.parametrize(('numbers', 'expected'), [
+    ([], []),
+    ([4], [(4, 4)]),
+    ([1, 2, 3, 7], [(1, 3), (7, 7)]),
+    ([1, 3, 5], [(1, 1), (3, 3), (5, 5)]),
+    ([2, 3, 4, 5, 9, 10], [(2, 5), (9, 10)]),
+])
+def test_to_ranges(numbers, expected):
+    assert to_ranges(numbers) == expected
+
+def test_make_cache_key():
+    key = make_cache_key("abc", 1, 200, None, "PNG", True)
+    assert key == make_cache_key("abc", 1, 200, None, "PNG", True)
+    assert key == make_cache_key("abc", 1, 200, "rgb", "PNG", True)
+    # Everything that changes the output bytes changes the key.
+    assert len({key,
+                make_cache_key("abd", 1, 200, None, "PNG", True),
+                make_cache_key("abc", 2, 200, None, "PNG", True),
+                make_cache_key("abc", 1, 300, None, "PNG", True),
+                make_cache_key("abc", 1, 200, "gray", "PNG", True),
+                make_cache_key("abc", 1, 200, None, "JPEG", True),
+                make_cache_key("abc", 1, 200, None, "PNG", False),
+                make_cache_key("abc", "multi:None", 200, None, "PNG", True)}) == 8
+
+def test_cache_evict(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    src = tmp_path / "page.bin"
+    src.write_bytes(b"x" * 100)
+    keys = [make_cache_key("abc", n, 200, None, "PNG", True) for n in range(5)]
+    for age, key in enumerate(keys):
+        cache_put(cache_dir, key, str(src))
+        # keys[0] is the newest.
+        os.utime(cache_path(cache_dir, key), (1000 - age, 1000 - age))
+
+    cache_evict(cache_dir, 250)
+
+    assert [os.path.exists(cache_path(cache_dir, key)) for key in keys] == [True, True, False, False, False]
+    cache_evict(cache_dir, 1000)
+    assert os.path.exists(cache_path(cache_dir, keys[1]))
+    cache_evict(cache_dir, 0)
+    assert not os.path.exists(cache_path(cache_dir, keys[0]))
+
+@pytest.mark.parametrize(('fmt', 'suffix'), [("PNG", ".png"), ("TIFF", ".tif")])
+def test_convert_image_cache(poppler, tmp_path, fmt, suffix):
+    pdf = tmp_path / "doc.pdf"
+    pdf.write_bytes(b"%PDF-1.4 fake")
+    cache_dir = str(tmp_path / "cache")
+    out = tmp_path / "out"
+    out.mkdir()
+
+    assert convert_image(str(pdf), str(out), fmt, suffix, 200, False, False, pages=[(1, 4)], cache_dir=cache_dir)
+    for name in os.listdir(out):
+        os.remove(out / name)
+    # Only the pages that are not cached yet are rendered.
+    assert convert_image(str(pdf), str(out), fmt, suffix, 200, False, False, pages=[(2, 3), (6, 7)], cache_dir=cache_dir)
+    assert convert_image(str(pdf), str(out), fmt, suffix, 200, False, False, pages=[(1, 7)], cache_dir=cache_dir)
+
+    assert [(c["first_page"], c["last_page"]) for c in poppler.calls] == [(1, 4), (6, 7), (5, 5)]
+    assert sorted(os.listdir(out)) == ["doc_%03d%s" % (n, suffix) for n in range(1, 8)]
+    assert [page_level(out / ("doc_%03d%s" % (n, suffix))) for n in range(1, 8)] == [10 * n for n in range(1, 8)]
+
+    # A different dpi is a different page.
+    assert convert_image(str(pdf), str(out), fmt, suffix, 300, False, False, pages=[(1, 1)], cache_dir=cache_dir)
+    assert poppler.calls[-1]["dpi"] == 300
+
+@pytest.mark.parametrize(('ranges', 'size', 'expected'), [
+    ([(1, 5), (9, 9)], 2, [(1, 2), (3, 4), (5, 5), (9, 9)]),
+    ([(1, 12)], 16, [(1, 12)]),
+    ([(3, 8)], 3, [(3, 5), (6, 8)]),
+    ([(1, 3)], 1, [(1, 1), (2, 2), (3, 3)]),
+    ([], 4, []),
+])
+def test_split_ranges(ranges, size, expected):
+    assert list(split_ranges(ranges, size)) == expected
+
+def test_convert_image_known_info(poppler, tmp_path, monkeypatch):
+    def no_digest(f):
+        raise AssertionError("digest computed again")
+    monkeypatch.setattr(pdftoimg, "file_digest", no_digest)
+
+    assert convert_image("doc.pdf", str(tmp_path), "PNG", ".png", 200, False, False, pages=[(1, 2)], max_size=(800, 800),
+                         cache_dir=str(tmp_path / "cache"), info=A4_INFO, digest="abc")
+    assert poppler.pdfinfo_calls == 0
+
+def test_convert_image_error(poppler, tmp_path, capsys):
+    # pdf2image errors are not OSError; they are reported like any other failure.
+    assert not convert_image("bad.pdf", str(tmp_path), "PNG", ".png", 200, False, False)
+    assert capsys.readouterr().out == "Error: bad.pdf\n"
+
+@pytest.mark.parametrize('multi', [False, True])
+def test_convert_all(poppler, tmp_path, capsys, monkeypatch, multi):
+    src = tmp_path / "src"
+    src.mkdir()
+    files = []
+    for name in ["a.pdf", "bad.pdf", "c.pdf"]:
+        (src / name).write_bytes(b"%PDF-1.4 " + name.encode())
+        files.append(str(src / name))
+    out = tmp_path / "out"
+    out.mkdir()
+    poppler.log = str(tmp_path / "pdfinfo.log")
+    digests = tmp_path / "digest.log"
+    file_digest = pdftoimg.file_digest
+    def logged_digest(f):
+        with open(digests, "a") as log:
+            log.write(os.path.basename(f) + "\n")
+        return file_digest(f)
+    monkeypatch.setattr(pdftoimg, "file_digest", logged_digest)
+
+    failed = convert_all(files, str(out), "TIFF", ".tif", 200, multi, True, 2, pages=[(1, 6)], cache_dir=str(tmp_path / "cache"))
+
+    assert failed == [files[1]]
+    if multi:
+        assert sorted(os.listdir(out)) == ["a.tif", "c.tif"]
+    else:
+        assert sorted(os.listdir(out)) == ["%s_%03d.tif" % (name, n) for name in "ac" for n in range(1, 7)]
+    # pdfinfo and the digest run once per PDF, not once per page range.
+    assert sorted(open(poppler.log).read().split()) == ["a.pdf", "bad.pdf", "c.pdf"]
+    assert sorted(open(digests).read().split()) == ["a.pdf", "c.pdf"]
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Error: " + files[1]
+    assert sorted(lines[1:]) == sorted([f + " > <Success> " + str(out) for f in (files[0], files[2])])